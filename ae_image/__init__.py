@@ -5,5 +5,6 @@ collection of images stored in a ``db.Model`` and efficiently serve them.
 
 """
 
-from ae_image.core import Style, Collection, UrlNotFound
-from ae_image.db_property import Property
+from ae_image.core import Style, Conversion, Collection, Summary, UrlNotFound
+from ae_image.db_property import Property, SummaryProperty
+from ae_image.serving import CircuitBreaker, UrlPolicy
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+Backfill of serving URLs across all entities of a model, for when a new
+``Style`` is added to an ``ae_image.Property``. The key space is split into
+shards, each of which runs as a chain of named deferred tasks, so a retried
+task does not start a second chain for its shard. Every batch of
+entities gets the missing URLs generated in a single round of concurrent
+RPCs. The URLs are then copied into each entity in a transaction that reads
+it again, so images appended or removed while the URLs were generated are
+kept. Progress is checkpointed per shard using a query cursor::
+
+    job_id = backfill.start(Album, 'images', shards=16)
+    backfill.progress(job_id)
+
+URLs that could not be generated within the property's ``url_policy`` are
+counted as pending, and running the job again picks them up. Pairs failing
+with an error that retrying will not fix, like a deleted blob or one that is
+not an image, are logged and counted as failed, and the job moves on.
+
+With ``resave`` every entity is saved, even if no URL was generated, which
+writes properties derived on save like an ``ae_image.SummaryProperty``.
+
+The deferred builtin must be enabled in ``app.yaml``.
+
+"""
+
+import logging
+import uuid
+from google.appengine.api import taskqueue
+from google.appengine.ext import db, deferred
+from ae_image import serving
+
+
+class BackfillShard(db.Model):
+    """Checkpoint and progress of one shard of a backfill job."""
+
+    job_id = db.StringProperty()
+    start_key = db.StringProperty(indexed=False)
+    end_key = db.StringProperty(indexed=False)
+    cursor = db.TextProperty()
+    processed = db.IntegerProperty(default=0, indexed=False)
+    updated = db.IntegerProperty(default=0, indexed=False)
+    generated = db.IntegerProperty(default=0, indexed=False)
+    pending = db.IntegerProperty(default=0, indexed=False)
+    failed = db.IntegerProperty(default=0, indexed=False)
+    done = db.BooleanProperty(default=False, indexed=False)
+
+
+def split_ranges(keys, shards):
+    """
+    Split the key space into at most ``shards`` ranges using the given sample
+    of keys. Ranges are ``(start, end)`` pairs where ``None`` is unbounded.
+
+    """
+
+    keys = sorted(keys)
+    count = min(shards, len(keys) + 1)
+    splits = [keys[len(keys) * i // count] for i in range(1, count)]
+    return zip([None] + splits, splits + [None])
+
+
+def plan(model, job_id, shards, oversample=4):
+    """
+    Create and return the shards for a job, splitting the key space using the
+    ``__scatter__`` sample of the model's keys.
+
+    """
+
+    query = db.Query(model, keys_only=True).order('__scatter__')
+    ranges = split_ranges(query.fetch(shards * oversample), shards)
+    entities = [
+        BackfillShard(key_name='%s-%d' % (job_id, i), job_id=job_id,
+                      start_key=start and str(start),
+                      end_key=end and str(end))
+        for i, (start, end) in enumerate(ranges)]
+    db.put(entities)
+    return entities
+
+
+def start(model, property_name, shards=8, batch_size=50,
+          batches_per_task=10, queue_name='default', resave=False):
+    """Start a backfill job and return its id."""
+
+    job_id = uuid.uuid4().hex
+    for shard in plan(model, job_id, shards):
+        _defer_shard(model, property_name, shard.key().name(), batch_size,
+                     batches_per_task, queue_name, resave, 0)
+    return job_id
+
+
+def _defer_shard(model, property_name, shard_name, batch_size,
+                 batches_per_task, queue_name, resave, task_number):
+    """
+    Add the named task to run the given shard. If the task was already added
+    by an earlier attempt of the task continuing the chain, it is left as is.
+
+    """
+
+    try:
+        deferred.defer(run_shard, model, property_name, shard_name,
+                       batch_size, batches_per_task, queue_name, resave,
+                       task_number, _queue=queue_name,
+                       _name='%s-%d' % (shard_name, task_number))
+    except (taskqueue.TaskAlreadyExistsError,
+            taskqueue.TombstonedTaskError), _ex:
+        pass
+
+
+def run_shard(model, property_name, shard_name, batch_size=50,
+              batches_per_task=10, queue_name='default', resave=False,
+              task_number=0):
+    """
+    Process up to ``batches_per_task`` batches of a shard, and continue in a
+    new task if the shard is not done yet. The ``task_number`` counts the
+    tasks in the chain of the shard, and names the next one.
+
+    """
+
+    shard = BackfillShard.get_by_key_name(shard_name)
+    for _ in range(batches_per_task):
+        if shard.done:
+            return
+        process_batch(model, property_name, shard, batch_size, resave)
+    if not shard.done:
+        _defer_shard(model, property_name, shard_name, batch_size,
+                     batches_per_task, queue_name, resave, task_number + 1)
+
+
+def process_batch(model, property_name, shard, batch_size, resave=False):
+    """
+    Generate missing URLs for the next batch of entities in a shard. With
+    ``resave`` all entities in the batch are saved.
+
+    """
+
+    query = model.all().order('__key__')
+    if shard.start_key:
+        query.filter('__key__ >=', db.Key(shard.start_key))
+    if shard.end_key:
+        query.filter('__key__ <', db.Key(shard.end_key))
+    if shard.cursor:
+        query.with_cursor(shard.cursor)
+    entities = query.fetch(batch_size)
+
+    pairs = []
+    owners = {}
+    for entity in entities:
+        collection = getattr(entity, property_name)
+        if collection is None:
+            continue
+        for image, style in serving.missing(
+                collection.images.values(), collection.styles.values()):
+            pairs.append((image, style))
+            owners[id(image)] = entity.key()
+
+    policy = getattr(model, property_name).url_policy
+    errors = []
+    updates = {}
+    if resave:
+        for entity in entities:
+            updates[entity.key()] = []
+    for image in serving.generate_urls(pairs, policy, errors):
+        updates.setdefault(owners[id(image)], []).append(image)
+    changed = 0
+    for key, image_list in updates.items():
+        if db.run_in_transaction(
+                _save_urls, key, property_name, image_list, resave):
+            changed += 1
+
+    shard.cursor = query.cursor()
+    shard.processed += len(entities)
+    shard.updated += changed
+    generated = len([1 for image, style in pairs if style in image.blobs])
+    for image, style, error in errors:
+        logging.warning('No URL for blob %s style %s: %r',
+                        image.blob_key, style.name, error)
+    shard.generated += generated
+    shard.failed += len(errors)
+    shard.pending += len(pairs) - generated - len(errors)
+    shard.done = len(entities) < batch_size
+    shard.put()
+    return shard
+
+
+def _save_urls(key, property_name, image_list, resave=False):
+    """
+    Copy the URLs generated for the given images into the stored entity, and
+    save it if any were missing or ``resave`` is set. Must run in a
+    transaction. Returns ``True`` if the entity was saved.
+
+    """
+
+    entity = db.get(key)
+    if entity is None:
+        return False
+
+    collection = getattr(entity, property_name)
+    if collection is None:
+        if resave:
+            entity.put()
+        return resave
+    modified = False
+    for image in image_list:
+        current = collection.images.get(image.key)
+        if current is None:
+            continue
+        styles = [s for s in image.blobs if s not in current.blobs]
+        for style in styles:
+            current.blobs[style] = image.blobs[style]
+        if styles:
+            current.set_url_table(collection.url_table)
+            collection.touch(current)
+            modified = True
+
+    if modified or resave:
+        entity.put()
+    return modified or resave
+
+
+def progress(job_id):
+    """Summary of the progress of a job across all its shards."""
+
+    shards = BackfillShard.all().filter('job_id =', job_id).fetch(1000)
+    return {
+        'shards': len(shards),
+        'done': len([s for s in shards if s.done]),
+        'processed': sum([s.processed for s in shards]),
+        'updated': sum([s.updated for s in shards]),
+        'generated': sum([s.generated for s in shards]),
+        'pending': sum([s.pending for s in shards]),
+        'failed': sum([s.failed for s in shards]),
+    }
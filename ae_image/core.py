@@ -8,6 +8,9 @@ the ``Collection`` class defined here.
 
 """
 
+from __future__ import with_statement
+from ae_image import serving
+from google.appengine.api import files, images
 from google.appengine.api.images import get_serving_url
 from ordereddict import OrderedDict
 from os import environ
@@ -118,37 +121,227 @@ class Style(object):
         return hash(self.serving_key())
 
 
+class Conversion(object):
+    """
+    Defines a lossless conversion applied to images of the given content types
+    when they are added to a collection. The converted blob is only used if it
+    is smaller than the uploaded one, and images the images service fails to
+    convert are kept as uploaded. Unless ``keep_source`` is set the uploaded
+    blob is no longer referenced, and ``Collection.delete_pending`` deletes it
+    once the collection has been saved. The image stays in the collection
+    under the uploaded blob key.
+
+    The conversion is lossless for BMP images and for single page TIFF images
+    with 8 bits per channel in RGB or greyscale. The images service only keeps
+    the first page of a multi-page TIFF, and TIFF images with 16 bits per
+    channel or in CMYK lose data. TIFF is therefore not converted by default,
+    only add ``image/tiff`` to the content types if such images cannot be
+    uploaded, or together with ``keep_source``.
+
+    """
+
+    formats = {
+        'png': (images.PNG, 'image/png'),
+    }
+
+    def __init__(self, content_types=('image/bmp', 'image/x-bmp',
+                                      'image/x-ms-bmp'),
+                 format='png', keep_source=False):
+        if format not in self.formats:
+            raise ValueError('"format" must be one of: %s' %
+                             ', '.join(self.formats))
+        self.content_types = content_types
+        self.format = format
+        self.keep_source = keep_source
+
+    def __repr__(self):
+        ret = u'<Conversion %s to %s' % (
+            u', '.join(self.content_types), self.format)
+        if self.keep_source:
+            ret += u' (keep source)'
+        ret += '>'
+        return ret
+
+    def convert(self, image, size=None):
+        """
+        Convert the given ``Image`` if it has one of the configured content
+        types. The ``size`` of the uploaded blob is looked up if it is not
+        given. Returns ``True`` if the image now refers to a converted blob.
+        The uploaded blob is not deleted here, since the image may never be
+        saved.
+
+        """
+
+        if image.content_type not in self.content_types:
+            return False
+
+        encoding, content_type = self.formats[self.format]
+        source = images.Image(blob_key=image.blob_key)
+        # a transform is required, cropping nothing is one that is lossless
+        source.crop(0.0, 0.0, 1.0, 1.0)
+        try:
+            data = source.execute_transforms(output_encoding=encoding)
+        except images.Error, _ex:
+            # too large or not an image the service can decode, keep it as is
+            return False
+
+        source_size = size
+        if source_size is None:
+            source_size = blobstore.BlobInfo.get(image.blob_key).size
+        if len(data) >= source_size:
+            return False
+
+        file_name = files.blobstore.create(mime_type=content_type)
+        with files.open(file_name, 'a') as blob_file:
+            blob_file.write(data)
+        files.finalize(file_name)
+
+        if self.keep_source:
+            image.source_blob_key = image.blob_key
+        image.blob_key = str(files.blobstore.get_blob_key(file_name))
+        image.content_type = content_type
+        image.bytes_saved = source_size - len(data)
+        return True
+
+
+class UrlTable(object):
+    """
+    Table of the prefixes shared by serving URLs, everything up to and
+    including the last "/". This allows storing a URL as the index of its
+    prefix and the remaining unique suffix.
+
+    """
+
+    def __init__(self):
+        self.prefixes = []
+        self._index = None
+
+    def __repr__(self):
+        return u'<UrlTable %r>' % self.prefixes
+
+    def __getstate__(self):
+        return {'prefixes': self.prefixes}
+
+    def __setstate__(self, state):
+        self.prefixes = state['prefixes']
+        self._index = None
+
+    def split(self, url):
+        """Split a URL into the index of its prefix and the suffix."""
+
+        if self._index is None:
+            self._index = dict([(p, i) for i, p in enumerate(self.prefixes)])
+
+        cut = url.rfind('/') + 1
+        prefix = url[:cut]
+        index = self._index.get(prefix)
+        if index is None:
+            index = self._index[prefix] = len(self.prefixes)
+            self.prefixes.append(prefix)
+        return index, url[cut:]
+
+    def join(self, index, suffix):
+        """Rebuild a URL from the index of its prefix and the suffix."""
+
+        return self.prefixes[index] + suffix
+
+
 class Blob(object):
     """
-    Defines a blob storing an image and associated serving URL.
+    Defines a blob storing an image and associated serving URL. If a
+    ``UrlTable`` is given, the URL is stored as a prefix index and suffix and
+    only rebuilt when it is requested.
 
     """
 
-    def __init__(self, blob_key, content_type, serving_url):
+    def __init__(self, blob_key, content_type, serving_url, url_table=None):
         self.blob_key = str(blob_key)
         self.content_type = content_type
+        self.url_table = url_table
+        self._prefix = None
+        self._suffix = None
         self.serving_url = serving_url
 
     def __repr__(self):
         return u'<Blob "%s": %s, Serving URL: %s>' % \
             (self.blob_key, self.content_type, self.serving_url)
 
+    def __setstate__(self, state):
+        # blobs stored before URL tables were used have the full URL
+        if 'serving_url' in state:
+            state = state.copy()
+            state['_suffix'] = state.pop('serving_url')
+            state['_prefix'] = None
+            state['url_table'] = None
+        self.__dict__.update(state)
+
+    def get_url(self):
+        """Get the full serving URL."""
+
+        if self._prefix is None:
+            return self._suffix
+        return self.url_table.join(self._prefix, self._suffix)
+
+    def set_url(self, serving_url):
+        """Set the serving URL, splitting it if there is a URL table."""
+
+        if self.url_table is None:
+            self._prefix, self._suffix = None, serving_url
+        else:
+            self._prefix, self._suffix = self.url_table.split(serving_url)
+    serving_url = property(get_url, set_url)
+
+    def set_url_table(self, url_table):
+        """Store the serving URL using the given URL table."""
+
+        serving_url = self.serving_url
+        self.url_table = url_table
+        self.serving_url = serving_url
+
+    def share_suffix(self, others):
+        """
+        Use the suffix string of another blob with the same suffix, so it is
+        only stored once.
+
+        """
+
+        for other in others:
+            if other is not self and other._suffix == self._suffix:
+                self._suffix = other._suffix
+                return
+
 
 class Image(object):
     """
-    Represents an original image and various styles of that image.
+    Represents an original image and various styles of that image. The
+    ``key`` is the blob key the image was uploaded as, which it is stored
+    under in a collection. If the image was converted, ``blob_key`` refers to
+    the converted blob, ``source_blob_key`` refers to the uploaded blob if it
+    was kept, and ``bytes_saved`` is the difference in size.
 
     """
 
-    def __init__(self, blob_key, content_type, blobs=None):
-        self.blob_key = str(blob_key)
+    # defaults for images stored before conversions and URL tables were
+    # supported
+    source_blob_key = None
+    bytes_saved = 0
+    url_table = None
+
+    def __init__(self, blob_key, content_type, blobs=None, url_table=None):
+        self.key = self.blob_key = str(blob_key)
         self.content_type = content_type
         self.blobs = blobs or {}
-        #TODO automatically do lossless conversions like bmp/tiff to png
+        self.url_table = url_table
 
     def __repr__(self):
         return '<Image "%s" with blobs %r>' % (self.blob_key, self.blobs)
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # images stored before conversions were supported have no key
+        if 'key' not in state:
+            self.key = self.blob_key
+
     def get_url(self, style):
         """Get a URL for this image based on the given style."""
 
@@ -171,18 +364,48 @@ class Image(object):
 
         if style not in self.blobs:
             #TODO handle format conversion
-            serving_url = get_serving_url(self.blob_key)
-
-            # in the development environment it is not desirable to have the
-            # address/port in the serving url
-            if _is_dev_environment:
-                serving_url = serving_url[serving_url.find('/', 9):]
-
-            self.blobs[style] = \
-                Blob(self.blob_key, self.content_type, serving_url)
+            self.set_serving_url(style, get_serving_url(self.blob_key))
             return True
         return False
 
+    def set_serving_url(self, style, serving_url):
+        """
+        Store a serving URL obtained from the images service for the given
+        style.
+
+        """
+
+        # in the development environment it is not desirable to have the
+        # address/port in the serving url
+        if _is_dev_environment:
+            serving_url = serving_url[serving_url.find('/', 9):]
+
+        blob = Blob(
+            self.blob_key, self.content_type, serving_url, self.url_table)
+        blob.share_suffix(self.blobs.values())
+        self.blobs[style] = blob
+
+    def set_url_table(self, url_table):
+        """Store the serving URLs of this image using the given URL table."""
+
+        self.url_table = url_table
+        for blob in self.blobs.values():
+            blob.set_url_table(url_table)
+            blob.share_suffix(self.blobs.values())
+
+    def missing_styles(self, styles):
+        """
+        Get the styles from the given list that need a URL generated. Only one
+        style is returned per serving key.
+
+        """
+
+        missing = {}
+        for style in styles:
+            if style not in self.blobs:
+                missing.setdefault(style, style)
+        return missing.values()
+
     def remove(self):
         """
         Remove the original image blob and any additional blobs we may have
@@ -190,8 +413,15 @@ class Image(object):
 
         """
 
-        blobstore.delete(
-            [self.blob_key] + [b.blob_key for b in self.blobs.values()])
+        blobstore.delete(self.blob_keys())
+
+    def blob_keys(self):
+        """All the blob keys referenced by this image."""
+
+        blob_keys = [self.blob_key] + [b.blob_key for b in self.blobs.values()]
+        if self.source_blob_key:
+            blob_keys.append(self.source_blob_key)
+        return blob_keys
 
 
 class Collection(object):
@@ -199,19 +429,47 @@ class Collection(object):
     The "image collection" is the core abstraction your application interacts
     with. You define a set of "styles" the images in this collection will be
     utilized in, add/remove images as well as get serving URLs for the
-    named styles.
+    named styles. Optionally a ``Conversion`` is applied to images as they
+    are added, and a ``serving.UrlPolicy`` bounds the time spent generating
+    URLs.
 
     """
 
-    def __init__(self, styles, images=None):
+    def __init__(self, styles, images=None, conversion=None, url_policy=None):
         self._styles = None
         self.styles = styles
         self.images = images or OrderedDict()
+        self.conversion = conversion
+        self.url_policy = url_policy
+        self.url_table = UrlTable()
+        self.version = 0
+        self._changes = []
+        self.stored_segments = None
+        self.pending_deletes = []
 
     def __repr__(self):
         return 'Collection:\nstyles: %r\nimages: %r' % \
             (self.styles, self.images)
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_changes']
+        del state['stored_segments']
+        del state['pending_deletes']
+        del state['conversion']
+        del state['url_policy']
+        return state
+
+    def __setstate__(self, state):
+        self.version = 0
+        self.url_table = UrlTable()
+        self.__dict__.update(state)
+        self.conversion = None
+        self.url_policy = None
+        self._changes = []
+        self.stored_segments = None
+        self.pending_deletes = []
+
     def set_styles(self, styles):
         """Set the styles images in this collection should be available in."""
 
@@ -242,46 +500,107 @@ class Collection(object):
 
         return image.get_url(style)
 
+    @property
+    def bytes_saved(self):
+        """Total bytes saved by converting the images in this collection."""
+
+        return sum([image.bytes_saved for image in self.images.values()])
+
     def get_urls(self, style_name):
         """
         Iterator to get serving URLs for all images in this collection for the
-        named style.
+        named style. The URL is ``None`` for images still pending a URL for
+        the style.
 
         """
 
+        try:
+            style = self.styles[style_name]
+        except KeyError, _ex:
+            raise UnknownStyle(style_name)
+
         for image in self.images.values():
-            yield image.blob_key, image.get_url(self.styles[style_name])
+            try:
+                yield image.key, image.get_url(style)
+            except UrlNotFound, _ex:
+                yield image.key, None
 
     def generate_urls(self):
         """
         This will generate URLs for all defined styles. It will return
         ``True`` if a new URL was generated and the data needs to get saved.
+        URLs which could not be generated within the ``url_policy`` are left
+        pending.
 
         """
 
-        modified = False
-        for image in self.images.values():
-            for style in self.styles.values():
-                if image.generate_url(style):
-                    modified = True
-        return modified
+        modified = serving.generate_urls(
+            serving.missing(self.images.values(), self.styles.values()),
+            self.url_policy)
+        map(self.touch, modified)
+        return bool(modified)
 
-    def append(self, blob_key, content_type):
+    def append(self, blob_key, content_type, size=None):
         """
-        Add a new image identified by the given blob_key and generate the
-        necessary URLs for the configured styles.
+        Add a new image identified by the given blob_key, converting it if a
+        conversion is configured, and generate the necessary URLs for the
+        configured styles. The image is identified by the given blob_key even
+        if it was converted, and the ``size`` of the blob is only used for a
+        conversion. URLs which could not be generated within the
+        ``url_policy`` are left pending.
 
         """
 
-        blob_key = str(blob_key)
-        self.images[blob_key] = image = Image(blob_key, content_type)
-        map(image.generate_url, self.styles.values())
-        return self
+        image = Image(blob_key, content_type, url_table=self.url_table)
+        self.convert(image, size)
+        serving.generate_urls(
+            serving.missing([image], self.styles.values()), self.url_policy)
+        return self.add(image)
+
+    def convert(self, image, size=None):
+        """
+        Apply the configured conversion to an ``Image`` about to be added.
+        Returns ``True`` if it was converted. An uploaded blob which is no
+        longer referenced is deleted by ``delete_pending``.
+
+        """
+
+        if not self.conversion:
+            return False
+        uploaded = image.blob_key
+        converted = self.conversion.convert(image, size)
+        if converted and image.source_blob_key != uploaded:
+            self.pending_deletes.append(uploaded)
+        return converted
+
+    def delete_pending(self):
+        """
+        Delete the uploaded blobs replaced by a conversion. Call this once the
+        collection has been saved, if the save failed they are left for the
+        sweeper instead. Returns the deleted blob keys.
+
+        """
+
+        blob_keys, self.pending_deletes = self.pending_deletes, []
+        if blob_keys:
+            blobstore.delete(blob_keys)
+        return blob_keys
+
+    def pending(self):
+        """
+        List of images which are still missing a URL for one of the
+        configured styles.
+
+        """
+
+        return [image for image in self.images.values()
+                if image.missing_styles(self.styles.values())]
 
     def append_from_blob_info(self, blob_info):
         """Add a new image from the given blob_info object."""
 
-        return self.append(blob_info.key(), blob_info.content_type)
+        return self.append(
+            blob_info.key(), blob_info.content_type, blob_info.size)
 
     def remove(self, blob_key):
         """
@@ -289,6 +608,34 @@ class Collection(object):
 
         """
 
+        self.discard(blob_key).remove()
+        return self
+
+    def add(self, image):
+        """
+        Add an ``Image`` to this collection as is, without generating any
+        URLs for it.
+
+        """
+
+        if image.url_table is not self.url_table:
+            image.set_url_table(self.url_table)
+        self.images[image.key] = image
+        self._record('append', image)
+        return self
+
+    def touch(self, image):
+        """Record that an ``Image`` in this collection was modified."""
+
+        self._record('update', image)
+
+    def discard(self, blob_key):
+        """
+        Take the image identified by the given blob_key out of this collection
+        without removing the associated blobs. Returns the ``Image``.
+
+        """
+
         blob_key = str(blob_key)
 
         try:
@@ -296,5 +643,77 @@ class Collection(object):
         except KeyError, _ex:
             raise UnknownImage(blob_key)
 
-        image.remove()
-        return self
+        self._record('remove', blob_key)
+        return image
+
+    def _record(self, operation, value):
+        """Record a change and bump the version of this collection."""
+
+        self._changes.append((operation, value))
+        self.version += 1
+
+    def pop_changes(self):
+        """
+        Return the list of changes made since the last call and forget them.
+        Each change is a tuple of the operation (``append``, ``update`` or
+        ``remove``) and the ``Image`` or blob_key it applies to.
+
+        """
+
+        changes, self._changes = self._changes, []
+        return changes
+
+    def apply_changes(self, changes):
+        """Replay changes as returned by ``pop_changes`` on this collection."""
+
+        for operation, value in changes:
+            if operation == 'remove':
+                self.images.pop(value, None)
+            else:
+                if value.url_table is not self.url_table:
+                    value.set_url_table(self.url_table)
+                self.images[value.key] = value
+        self.version += len(changes)
+
+
+class Summary(object):
+    """
+    A small summary of a ``Collection`` for listing pages: the number of
+    images, the version of the collection and the URLs of the first few
+    images in a single style, with the blob keys of as many of them as fit.
+
+    """
+
+    def __init__(self, count=0, version=0, blob_keys=None, urls=None):
+        self.count = count
+        self.version = version
+        self.blob_keys = blob_keys or []
+        self.urls = urls or []
+
+    def __repr__(self):
+        return u'<Summary %d images, version %d, covers %r>' % \
+            (self.count, self.version, self.covers())
+
+    @classmethod
+    def from_collection(cls, collection, style_name, size):
+        """Summarize the collection using the URLs for the named style."""
+
+        blob_keys = collection.images.keys()[:size]
+        urls = []
+        for blob_key in blob_keys:
+            try:
+                urls.append(collection.get_url(style_name, blob_key))
+            except UrlNotFound, _ex:
+                urls.append(None)
+        return cls(
+            len(collection.images), collection.version, blob_keys, urls)
+
+    def covers(self):
+        """
+        List of blob_key and URL pairs for the summarized images. The
+        blob_key is ``None`` for covers whose blob key did not fit.
+
+        """
+
+        return [(i < len(self.blob_keys) and self.blob_keys[i] or None, url)
+                for i, url in enumerate(self.urls)]
@@ -6,11 +6,20 @@ client side performance. It can also be instructed to force served URLs to be
 in JPEG format of a certain quality for controlling file sizes accepting some
 lossy conversion.
 
+The collection is stored as a list of blobs, a snapshot followed by deltas
+for the images appended, updated or removed by later saves. For this to work
+images must be modified via the ``Collection`` methods.
+
 """
 
-import pickle
 from google.appengine.ext import db
-from ae_image.core import Collection
+from ae_image import segments, serving
+from ae_image.core import Collection, Summary, UrlTable
+
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
 
 
 class Property(db.Property):
@@ -18,12 +27,20 @@ class Property(db.Property):
 
     data_type = Collection
 
-    def __init__(self, styles, **kwargs):
+    def __init__(self, styles, conversion=None, url_policy=None,
+                 max_deltas=16, max_delta_ratio=0.5,
+                 max_bytes=segments.MAX_BYTES, **kwargs):
         super(Property, self).__init__(**kwargs)
         self.styles = styles
+        self.conversion = conversion
+        self.url_policy = url_policy or serving.UrlPolicy()
+        self.max_deltas = max_deltas
+        self.max_delta_ratio = max_delta_ratio
+        self.max_bytes = max_bytes
 
     def default_value(self):
-        return Collection(self.styles)
+        return Collection(self.styles, conversion=self.conversion,
+                          url_policy=self.url_policy)
 
     def empty(self, value):
         return not value or not value.images
@@ -36,10 +53,106 @@ class Property(db.Property):
 
     def get_value_for_datastore(self, model_instance):
         result = super(Property, self).get_value_for_datastore(model_instance)
-        result = pickle.dumps(result)
-        return db.Blob(result)
+        if result is None:
+            return None
+        return [db.Blob(s) for s in segments.dump(
+            result, self.max_deltas, self.max_delta_ratio, self.max_bytes)]
 
     def make_value_from_datastore(self, value):
-        value = pickle.loads(str(value))
+        if value is None:
+            return None
+        value = segments.load(value)
         value.styles = self.styles
+        value.conversion = self.conversion
+        value.url_policy = self.url_policy
         return super(Property, self).make_value_from_datastore(value)
+
+
+class SummaryProperty(db.Property):
+    """
+    A property storing a ``Summary`` of a ``Property`` on the same model,
+    which is updated every time the entity is saved. It is indexed, so listing
+    pages can use a projection query to load only the summaries::
+
+        class Album(db.Model):
+            images = ae_image.Property([ae_image.Style('thumb', size=50)])
+            summary = ae_image.SummaryProperty('images', 'thumb', size=4)
+
+        Album.all(projection=('summary',))
+
+    The summary must fit in an indexed value of 500 bytes. URLs are stored as
+    an index into a table of their prefixes and the remaining suffix, and
+    blob keys are only stored for as many covers as fit. If even the URLs of
+    ``size`` covers do not fit, covers are dropped from the end. If the
+    collection is ``None`` an empty summary is stored.
+
+    Entities saved before the summary property was added have no summary,
+    and are left out of projection queries on it until they are saved again.
+    A backfill job can save all of them::
+
+        backfill.start(Album, 'images', resave=True)
+
+    """
+
+    data_type = Summary
+    max_length = 500
+
+    def __init__(self, source, style_name, size=4, **kwargs):
+        super(SummaryProperty, self).__init__(**kwargs)
+        self.source = source
+        self.style_name = style_name
+        self.size = size
+
+    def validate(self, value):
+        if value is not None and not isinstance(value, Summary):
+            raise db.BadValueError(
+                'Property %s must be a Summary.' % self.name)
+        return super(SummaryProperty, self).validate(value)
+
+    def get_value_for_datastore(self, model_instance):
+        collection = getattr(model_instance, self.source)
+        if collection is None:
+            summary = Summary()
+        else:
+            summary = Summary.from_collection(
+                collection, self.style_name, self.size)
+        self.__set__(model_instance, summary)
+
+        while True:
+            value = self.encode(summary)
+            if len(value) <= self.max_length or not summary.urls:
+                return db.ByteString(value)
+            if summary.blob_keys:
+                summary.blob_keys.pop()
+            else:
+                summary.urls.pop()
+
+    def make_value_from_datastore(self, value):
+        if value is None:
+            return None
+        return self.decode(str(value))
+
+    @staticmethod
+    def encode(summary):
+        """Encode a ``Summary`` into its compact stored form."""
+
+        table = UrlTable()
+        covers = [url is not None and list(table.split(url)) or None
+                  for url in summary.urls]
+        return json.dumps(
+            [summary.count, summary.version, table.prefixes, covers,
+             summary.blob_keys], separators=(',', ':'))
+
+    @staticmethod
+    def decode(value):
+        """Decode a ``Summary`` from its stored form."""
+
+        data = json.loads(value)
+        # summaries stored before URLs were split hold the full URLs
+        if len(data) == 4:
+            return Summary(*data)
+        count, version, prefixes, covers, blob_keys = data
+        table = UrlTable()
+        table.prefixes = prefixes
+        urls = [cover and table.join(*cover) or None for cover in covers]
+        return Summary(count, version, blob_keys, urls)
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+Provides an ``ndb`` property storing a ``Collection``, and tasklet versions of
+the ``Collection`` operations that make RPCs. Using these a handler can
+overlap loading the entity, generating serving URLs and deleting blobs::
+
+    @ndb.tasklet
+    def add_image(album_key, blob_info):
+        album = yield album_key.get_async()
+        yield ndb_property.append_async(album.images, blob_info.key(),
+                                        blob_info.content_type, blob_info.size)
+        yield album.put_async()
+        yield ndb_property.delete_pending_async(album.images)
+
+The collection is stored in the same snapshot and delta format used by the
+``db`` property, with all segments kept in a single blob. Values written by
+the ``db`` property, a list of segments or a single pickled ``Collection``
+from earlier versions, are read as well, so a kind can be moved to this
+property. They are written back in the single blob form on the next save.
+
+"""
+
+import pickle
+import time
+from google.appengine.api import images
+from google.appengine.ext import blobstore, ndb
+from ae_image import segments, serving
+from ae_image.core import Collection, Image
+
+
+class Property(ndb.BlobProperty):
+    """An ndb property to store a Collection."""
+
+    def __init__(self, styles, conversion=None, url_policy=None,
+                 max_deltas=16, max_delta_ratio=0.5,
+                 max_bytes=segments.MAX_BYTES, **kwargs):
+        super(Property, self).__init__(**kwargs)
+        self.styles = styles
+        self.conversion = conversion
+        self.url_policy = url_policy or serving.UrlPolicy()
+        self.max_deltas = max_deltas
+        self.max_delta_ratio = max_delta_ratio
+        self.max_bytes = max_bytes
+
+    def _get_value(self, entity):
+        value = super(Property, self)._get_value(entity)
+        if value is None:
+            value = Collection(self.styles, conversion=self.conversion,
+                               url_policy=self.url_policy)
+            self._set_value(entity, value)
+        return value
+
+    def _validate(self, value):
+        if not isinstance(value, Collection):
+            raise ndb.BadValueError(
+                'Property %s must be a Collection.' % self._name)
+
+    def _to_base_type(self, value):
+        return pickle.dumps(segments.dump(
+            value, self.max_deltas, self.max_delta_ratio, self.max_bytes),
+            segments.PROTOCOL)
+
+    def _deserialize(self, entity, p, depth=1):
+        # the db property stores its segments as a list of values, which are
+        # deserialized one at a time and would replace each other
+        # pylint: disable=W0212
+        previous = None
+        if self._has_value(entity):
+            previous = self._retrieve_value(entity)
+        super(Property, self)._deserialize(entity, p, depth)
+        if isinstance(previous, ndb.model._BaseValue):
+            current = self._retrieve_value(entity)
+            self._store_value(entity, ndb.model._BaseValue(
+                _segment_list(previous.b_val) +
+                _segment_list(current.b_val)))
+
+    def _from_base_type(self, value):
+        if not isinstance(value, list):
+            stored = pickle.loads(value)
+            # a single pickled collection is read as a snapshot
+            if isinstance(stored, list):
+                value = stored
+        value = segments.load(value)
+        value.styles = self.styles
+        value.conversion = self.conversion
+        value.url_policy = self.url_policy
+        return value
+
+
+def _segment_list(value):
+    """The list of segments in a raw value, which may be a single one."""
+
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+@ndb.tasklet
+def get_serving_url_async(blob_key, policy=None, expires=None):
+    """
+    Tasklet to get a serving URL with the deadline, retries and circuit
+    breaker of the given ``serving.UrlPolicy``, within the budget of a batch
+    that runs out at ``expires``. Returns ``None`` if no URL could be
+    generated.
+
+    """
+
+    policy = policy or serving.UrlPolicy()
+    for attempt in range(policy.retries + 1):
+        if not policy.breaker.allow():
+            break
+        if attempt:
+            delay = policy.delay(attempt)
+            if expires and time.time() + delay >= expires:
+                break
+            yield ndb.sleep(delay)
+        deadline = policy.call_deadline_before(expires)
+        if deadline == 0:
+            break
+        try:
+            serving_url = yield images.get_serving_url_async(
+                blob_key, rpc=images.create_rpc(deadline=deadline))
+        except serving.TRANSIENT_ERRORS, _ex:
+            policy.breaker.failure()
+            continue
+        policy.breaker.success()
+        raise ndb.Return(serving_url)
+    raise ndb.Return(None)
+
+
+@ndb.tasklet
+def generate_image_urls_async(image, styles, policy=None, expires=None):
+    """
+    Tasklet to generate URLs for an ``Image`` for the given styles. The RPCs
+    for all styles are made concurrently, within the budget of a batch that
+    runs out at ``expires``, or a new batch if it is not given. Returns
+    ``True`` if a new URL was generated, URLs which could not be generated
+    are left pending.
+
+    """
+
+    policy = policy or serving.UrlPolicy()
+    if expires is None:
+        expires = policy.expires()
+    missing = image.missing_styles(styles)
+    serving_urls = yield [
+        get_serving_url_async(image.blob_key, policy, expires)
+        for _ in missing]
+    modified = False
+    for style, serving_url in zip(missing, serving_urls):
+        if serving_url is not None:
+            image.set_serving_url(style, serving_url)
+            modified = True
+    raise ndb.Return(modified)
+
+
+@ndb.tasklet
+def generate_urls_async(collection):
+    """
+    Tasklet version of ``Collection.generate_urls``. URLs for all images are
+    generated concurrently, within a single batch deadline.
+
+    """
+
+    policy = collection.url_policy or serving.UrlPolicy()
+    expires = policy.expires()
+    modified = yield [
+        generate_image_urls_async(
+            image, collection.styles.values(), policy, expires)
+        for image in collection.images.values()]
+    for image, image_modified in zip(collection.images.values(), modified):
+        if image_modified:
+            collection.touch(image)
+    raise ndb.Return(any(modified))
+
+
+@ndb.tasklet
+def append_async(collection, blob_key, content_type, size=None):
+    """
+    Tasklet version of ``Collection.append``. A configured conversion is
+    still done synchronously.
+
+    """
+
+    image = Image(blob_key, content_type)
+    collection.convert(image, size)
+    yield generate_image_urls_async(
+        image, collection.styles.values(), collection.url_policy)
+    raise ndb.Return(collection.add(image))
+
+
+@ndb.tasklet
+def delete_pending_async(collection):
+    """Tasklet version of ``Collection.delete_pending``."""
+
+    blob_keys, collection.pending_deletes = collection.pending_deletes, []
+    if blob_keys:
+        yield blobstore.delete_async(blob_keys)
+    raise ndb.Return(blob_keys)
+
+
+@ndb.tasklet
+def remove_async(collection, blob_key):
+    """Tasklet version of ``Collection.remove``."""
+
+    image = collection.discard(blob_key)
+    yield blobstore.delete_async(image.blob_keys())
+    raise ndb.Return(collection)
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Serialization of a ``Collection`` into a list of stored segments. The first
+segment is a pickled snapshot of the entire collection, and every following
+segment is a pickled delta of the changes made by one save. This keeps the
+cost of a save proportional to the change instead of the size of the
+collection. At most ``max_deltas`` deltas are kept, and a save that would
+add one more, make the deltas larger than ``max_delta_ratio`` of the
+snapshot, or make all segments together larger than ``max_bytes``, compacts
+them back into a single snapshot instead. The default ``max_bytes`` leaves
+room below the 1MB entity limit for the other properties of the entity.
+
+A value stored by earlier versions is a single pickled ``Collection`` and is
+read as a snapshot without any deltas.
+
+"""
+
+import pickle
+
+PROTOCOL = pickle.HIGHEST_PROTOCOL
+MAX_BYTES = 900 * 1024
+
+
+def dump(collection, max_deltas, max_delta_ratio, max_bytes=MAX_BYTES):
+    """
+    Return the list of segments to store for the given collection. Only the
+    changes made since it was last loaded or dumped are pickled, unless a
+    compaction is due.
+
+    """
+
+    segments = collection.stored_segments
+    changes = collection.pop_changes()
+
+    if segments and not changes:
+        return segments
+
+    if segments:
+        delta = pickle.dumps({'changes': changes}, PROTOCOL)
+        delta_size = len(delta) + sum([len(s) for s in segments[1:]])
+        if (len(segments) - 1 >= max_deltas or
+                delta_size > len(segments[0]) * max_delta_ratio or
+                delta_size + len(segments[0]) > max_bytes):
+            segments = None
+        else:
+            segments = segments + [delta]
+
+    if not segments:
+        segments = [pickle.dumps(collection, PROTOCOL)]
+
+    collection.stored_segments = segments
+    return segments
+
+
+def load(value):
+    """Return the ``Collection`` stored in the given segment(s)."""
+
+    if isinstance(value, (list, tuple)):
+        segments = [str(s) for s in value]
+    else:
+        segments = [str(value)]
+
+    collection = pickle.loads(segments[0])
+    for segment in segments[1:]:
+        collection.apply_changes(pickle.loads(segment)['changes'])
+    collection.stored_segments = segments
+    return collection
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Batched generation of serving URLs. The images service RPCs for all the
+requested images and styles are made concurrently instead of one after the
+other.
+
+A ``UrlPolicy`` bounds the time spent: every RPC has a deadline, the whole
+batch has a budget, transient failures are retried with jittered exponential
+backoff, and a ``CircuitBreaker`` stops calling a failing service altogether.
+Every policy has its own breaker, and the properties each create a policy if
+none is given, so a failing property does not stop the others. Without a
+policy a new default one is used for every call.
+URLs that could not be generated within the budget are left missing, and the
+image stays pending until a later ``Collection.generate_urls`` or backfill
+fills them in. Errors that will not go away by retrying, like a blob that is
+not an image, are raised, unless a list is passed in to collect them.
+
+"""
+
+from __future__ import with_statement
+import random
+import threading
+import time
+from google.appengine.api import images
+from google.appengine.runtime import apiproxy_errors
+
+TRANSIENT_ERRORS = (
+    apiproxy_errors.DeadlineExceededError,
+    apiproxy_errors.OverQuotaError,
+    images.TransformationError,
+)
+
+
+class CircuitBreaker(object):
+    """
+    Opens after ``threshold`` consecutive failures, and stays open for
+    ``reset_after`` seconds. Once that has passed calls are allowed again, and
+    a single failure opens it again. It is safe to share between threads.
+
+    """
+
+    def __init__(self, threshold=5, reset_after=30):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return u'<CircuitBreaker %s, %d failures>' % (
+            self.allow() and u'closed' or u'open', self.failures)
+
+    def allow(self):
+        """``True`` if calls are allowed."""
+
+        return (self.opened_at is None or
+                time.time() - self.opened_at >= self.reset_after)
+
+    def success(self):
+        """Record a successful call."""
+
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        """Record a failed call."""
+
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.time()
+
+
+class UrlPolicy(object):
+    """
+    Defines the deadline in seconds for each RPC and for a whole batch, the
+    number of retries and the base delay in seconds between them.
+
+    """
+
+    def __init__(self, call_deadline=5, batch_deadline=10, retries=2,
+                 backoff=0.1, breaker=None):
+        self.call_deadline = call_deadline
+        self.batch_deadline = batch_deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+
+    def __repr__(self):
+        return (u'<UrlPolicy call_deadline=%s batch_deadline=%s retries=%d>' %
+                (self.call_deadline, self.batch_deadline, self.retries))
+
+    def delay(self, attempt):
+        """Jittered delay before the given retry attempt, starting at 1."""
+
+        return self.backoff * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+
+    def expires(self):
+        """
+        The time at which the budget of a batch starting now runs out, or
+        ``None`` if there is no batch deadline.
+
+        """
+
+        return self.batch_deadline and time.time() + self.batch_deadline
+
+    def call_deadline_before(self, expires):
+        """
+        The deadline for an RPC started now in a batch whose budget runs out
+        at ``expires``. Returns ``0`` once the budget has run out.
+
+        """
+
+        if not expires:
+            return self.call_deadline
+        remaining = expires - time.time()
+        if remaining <= 0:
+            return 0
+        return min(self.call_deadline or remaining, remaining)
+
+
+def missing(image_list, styles):
+    """
+    List of image and style pairs for which a URL needs to be generated for
+    the given images and styles.
+
+    """
+
+    return [(image, style) for image in image_list
+            for style in image.missing_styles(styles)]
+
+
+def _start(blob_key, deadline):
+    """Start a serving URL RPC, returns ``None`` on a transient failure."""
+
+    try:
+        return images.get_serving_url_async(
+            blob_key, rpc=images.create_rpc(deadline=deadline))
+    except TRANSIENT_ERRORS, _ex:
+        return None
+
+
+def _fail(image, style, error, errors):
+    """Record or raise an error for a pair which retrying will not fix."""
+
+    if errors is None:
+        raise error
+    errors.append((image, style, error))
+
+
+def generate_urls(pairs, policy=None, errors=None):
+    """
+    Generate the serving URLs for the given image and style pairs, as
+    returned by ``missing``. Returns the list of images that were modified,
+    pairs that ran out of budget are skipped. If an ``errors`` list is given,
+    pairs failing with an error that retrying will not fix are added to it
+    as ``(image, style, error)`` instead of raising the error.
+
+    """
+
+    policy = policy or UrlPolicy()
+    breaker = policy.breaker
+    expires = policy.expires()
+    modified = []
+    seen = set()
+    attempt = 0
+
+    while pairs and breaker.allow():
+        deadline = policy.call_deadline_before(expires)
+        if deadline == 0:
+            break
+
+        started = []
+        for image, style in pairs:
+            try:
+                started.append(
+                    (image, style, _start(image.blob_key, deadline)))
+            except images.Error, _ex:
+                _fail(image, style, _ex, errors)
+        failed = []
+        for image, style, rpc in started:
+            serving_url = None
+            if rpc is not None:
+                try:
+                    serving_url = rpc.get_result()
+                except TRANSIENT_ERRORS, _ex:
+                    pass
+                except images.Error, _ex:
+                    _fail(image, style, _ex, errors)
+                    continue
+            if serving_url is None:
+                breaker.failure()
+                failed.append((image, style))
+                continue
+            breaker.success()
+            image.set_serving_url(style, serving_url)
+            if id(image) not in seen:
+                seen.add(id(image))
+                modified.append(image)
+
+        pairs = failed
+        attempt += 1
+        if not pairs or attempt > policy.retries:
+            break
+        delay = policy.delay(attempt)
+        if expires and time.time() + delay >= expires:
+            break
+        time.sleep(delay)
+
+    return modified
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+"""
+Garbage collection of blobs that are no longer referenced by any
+``Collection``. This happens if a save fails after ``Collection.append``, or
+if an entity is deleted without removing its images first.
+
+The sweep runs in three phases. First all entities of the given models are
+scanned and a ``SweepMark`` entity is written for every referenced blob key,
+then all ``BlobInfo`` entities are scanned and those without a mark are
+deleted, and finally the marks are deleted. Models using the ``db`` and the
+``ndb`` property are both supported. Every model storing a collection must be
+passed in, since blobs referenced only by models which are left out are
+deleted. Only blobs accepted by the ``blob_filter`` are ever deleted, by
+default those with an image content type, so blobs the application stores
+for other purposes are left alone.
+
+All phases work in bounded batches using query cursors, and the progress is
+kept in a small ``SweepState`` which can be pickled to resume the sweep in
+another request. The referenced blob keys are kept in the datastore, so the
+state stays the same size however many blobs there are.
+
+Blobs created shortly before the sweep started are never deleted, since they
+may belong to an upload that has not been saved to a collection yet.
+
+"""
+
+import datetime
+import logging
+import time
+import uuid
+from google.appengine.ext import blobstore, db
+from ae_image import db_property
+
+try:
+    from google.appengine.ext import ndb
+    from ae_image import ndb_property
+except ImportError:
+    ndb = None
+
+REFERENCES = 'references'
+BLOBS = 'blobs'
+CLEANUP = 'cleanup'
+DONE = 'done'
+
+
+class SweepMark(db.Model):
+    """Marks a blob key as referenced during the sweep with ``sweep_id``."""
+
+    sweep_id = db.StringProperty()
+
+    @staticmethod
+    def key_name(sweep_id, blob_key):
+        """The key name of the mark for a blob key in a sweep."""
+
+        return '%s:%s' % (sweep_id, blob_key)
+
+
+def is_ndb_model(model):
+    """``True`` if the given model class is an ``ndb`` model."""
+
+    return ndb is not None and issubclass(model, ndb.Model)
+
+
+def image_property_names(model):
+    """Names of the ``ae_image`` properties of the given model."""
+
+    # pylint: disable=W0212
+    if is_ndb_model(model):
+        return [prop._code_name for prop in model._properties.values()
+                if isinstance(prop, ndb_property.Property)]
+    return [name for name, prop in model.properties().items()
+            if isinstance(prop, db_property.Property)]
+
+
+def is_image(blob_info):
+    """The default blob filter, accepts blobs with an image content type."""
+
+    return (blob_info.content_type or '').startswith('image/')
+
+
+def referenced_blob_keys(collection):
+    """Iterator for all blob keys referenced by the given collection."""
+
+    for image in collection.images.values():
+        for blob_key in image.blob_keys():
+            yield blob_key
+
+
+class SweepState(object):
+    """
+    Progress of a sweep. This is returned by ``Sweeper.run`` and can be passed
+    back in to continue where it left off.
+
+    """
+
+    def __init__(self):
+        self.sweep_id = uuid.uuid4().hex
+        self.phase = REFERENCES
+        self.model_index = 0
+        self.cursor = None
+        self.marked = 0
+        self.started = datetime.datetime.utcnow()
+        self.scanned = 0
+        self.orphaned = 0
+
+    def __repr__(self):
+        return (u'<SweepState %s: %d marked, %d scanned, %d orphaned>' %
+                (self.phase, self.marked, self.scanned, self.orphaned))
+
+    @property
+    def done(self):
+        """``True`` once the sweep has completed."""
+
+        return self.phase == DONE
+
+
+class Sweeper(object):
+    """
+    Finds and deletes orphaned blobs not referenced by any of the given
+    ``db`` or ``ndb`` models. In ``dry_run`` mode orphaned blobs are only
+    counted and logged. The ``max_per_second`` rate limit applies to the
+    number of entities, marks and blobs processed. Only blobs for which
+    ``blob_filter`` returns ``True`` are deleted.
+
+    """
+
+    def __init__(self, models, batch_size=100, delete_batch_size=50,
+                 mark_batch_size=100, dry_run=False, max_per_second=None,
+                 min_age=datetime.timedelta(hours=1), blob_filter=is_image):
+        if not models:
+            raise ValueError('"models" must list every model with an '
+                             'ae_image property.')
+        for model in models:
+            if not image_property_names(model):
+                raise ValueError(
+                    'Model %s has no ae_image property.' % model.__name__)
+        self.models = models
+        self.batch_size = batch_size
+        self.delete_batch_size = delete_batch_size
+        self.mark_batch_size = mark_batch_size
+        self.dry_run = dry_run
+        self.max_per_second = max_per_second
+        self.min_age = min_age
+        self.blob_filter = blob_filter
+
+    def run(self, state=None, deadline=None):
+        """
+        Run the sweep until it is done, or until the given deadline (as
+        returned by ``time.time()``) has passed. Returns the state, which is
+        ``done`` if the sweep completed.
+
+        """
+
+        state = state or SweepState()
+        while not state.done:
+            if deadline is not None and time.time() > deadline:
+                break
+            self.step(state)
+        return state
+
+    def step(self, state):
+        """Process a single batch for the current phase of the sweep."""
+
+        if state.phase == REFERENCES:
+            count = self._scan_references(state)
+        elif state.phase == BLOBS:
+            count = self._scan_blobs(state)
+        elif state.phase == CLEANUP:
+            count = self._delete_marks(state)
+        else:
+            count = 0
+
+        self._throttle(count)
+        return state
+
+    def _throttle(self, count):
+        """Sleep long enough to process ``count`` items at the rate limit."""
+
+        if self.max_per_second and count:
+            time.sleep(count / float(self.max_per_second))
+
+    def _scan_references(self, state):
+        """Mark the blob keys referenced by the next batch of entities."""
+
+        if state.model_index >= len(self.models):
+            state.phase = BLOBS
+            state.cursor = None
+            return 0
+
+        model = self.models[state.model_index]
+        names = image_property_names(model)
+        if is_ndb_model(model):
+            entities, cursor = self._fetch_ndb(model, state.cursor)
+        else:
+            query = model.all()
+            if state.cursor:
+                query.with_cursor(state.cursor)
+            entities = query.fetch(self.batch_size)
+            cursor = query.cursor()
+
+        referenced = set()
+        for entity in entities:
+            for name in names:
+                collection = getattr(entity, name)
+                if collection:
+                    referenced.update(referenced_blob_keys(collection))
+        referenced = list(referenced)
+        for i in range(0, len(referenced), self.mark_batch_size):
+            chunk = referenced[i:i + self.mark_batch_size]
+            db.put([SweepMark(key_name=SweepMark.key_name(state.sweep_id, b),
+                              sweep_id=state.sweep_id) for b in chunk])
+            state.marked += len(chunk)
+            self._throttle(len(chunk))
+
+        if len(entities) < self.batch_size or not cursor:
+            state.model_index += 1
+            state.cursor = None
+        else:
+            state.cursor = cursor
+        return len(entities)
+
+    def _fetch_ndb(self, model, cursor):
+        """
+        Fetch the next batch of entities of an ``ndb`` model. Returns the
+        entities and the web safe cursor to continue from.
+
+        """
+
+        start = cursor and ndb.Cursor(urlsafe=cursor) or None
+        entities, cursor, _ = model.query().fetch_page(
+            self.batch_size, start_cursor=start)
+        return entities, cursor and cursor.urlsafe()
+
+    def _scan_blobs(self, state):
+        """Delete the orphaned blobs in the next batch of blobs."""
+
+        query = blobstore.BlobInfo.all()
+        if state.cursor:
+            query.with_cursor(state.cursor)
+        infos = query.fetch(self.batch_size)
+
+        cutoff = state.started - self.min_age
+        candidates = [str(info.key()) for info in infos
+                      if info.creation <= cutoff and self.blob_filter(info)]
+        marks = db.get([
+            db.Key.from_path(SweepMark.kind(), SweepMark.key_name(
+                state.sweep_id, blob_key)) for blob_key in candidates])
+        orphans = [blob_key for blob_key, mark in zip(candidates, marks)
+                   if mark is None]
+        state.scanned += len(infos)
+        state.orphaned += len(orphans)
+
+        if orphans:
+            if self.dry_run:
+                logging.info('Orphaned blobs: %s', ', '.join(orphans))
+            else:
+                self._delete(orphans)
+
+        if len(infos) < self.batch_size:
+            state.phase = CLEANUP
+            state.cursor = None
+        else:
+            state.cursor = query.cursor()
+        return len(infos)
+
+    def _delete_marks(self, state):
+        """Delete the next batch of marks written by this sweep."""
+
+        keys = SweepMark.all(keys_only=True).filter(
+            'sweep_id =', state.sweep_id).fetch(self.batch_size)
+        db.delete(keys)
+        if len(keys) < self.batch_size:
+            state.phase = DONE
+        return len(keys)
+
+    def _delete(self, blob_keys):
+        """Delete the given blob keys in concurrent chunks."""
+
+        rpcs = []
+        for i in range(0, len(blob_keys), self.delete_batch_size):
+            rpcs.append(blobstore.delete_async(
+                blob_keys[i:i + self.delete_batch_size]))
+        for rpc in rpcs:
+            rpc.get_result()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming export and import of collections, for moving them between
+applications or rebuilding them in bulk. The export writes one JSON record
+per line for every image::
+
+    {"key": ["Album", "main"], "image_key": "...", "blob_key": "...",
+     "content_type": "image/png", "source_blob_key": null, "bytes_saved": 0,
+     "urls": [[null, null, "http://..."], ["jpeg", 75, "http://..."]]}
+
+where ``key`` is the path of the entity, ``image_key`` is the key of the
+image in the collection, which differs from ``blob_key`` for a converted
+image, ``source_blob_key`` and ``bytes_saved`` are those of a converted
+image, and ``urls`` holds the serving URL for every serving key (format and
+quality) of the image. The records for an entity are written in order, one
+after the other. An entity with an empty collection, or without one, is
+written as a single record with only the ``key``, and imported with an empty
+collection.
+
+Entities are read and written in batches so only a batch of entities is held
+in memory at any time.
+
+"""
+
+from itertools import groupby
+from google.appengine.ext import db
+from ae_image.core import Blob, Image, Style
+
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+
+def export_collections(model, property_name, out, cursor=None,
+                       batch_size=100, max_batches=None):
+    """
+    Write the images in the named property of all entities of the given
+    model to the file like object ``out``. Returns the cursor to pass back in
+    to resume the export after ``max_batches`` batches, or ``None`` if the
+    export has completed.
+
+    """
+
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        query = model.all()
+        if cursor:
+            query.with_cursor(cursor)
+        entities = query.fetch(batch_size)
+        for entity in entities:
+            path = entity.key().to_path()
+            collection = getattr(entity, property_name)
+            if collection is None or not collection.images:
+                out.write(json.dumps({'key': path}) + '\n')
+                continue
+            for image in collection.images.values():
+                out.write(json.dumps(image_record(path, image)) + '\n')
+        batches += 1
+        if len(entities) < batch_size:
+            return None
+        cursor = query.cursor()
+    return cursor
+
+
+def image_record(path, image):
+    """The export record for an ``Image`` of the entity with the given path."""
+
+    return {
+        'key': path,
+        'image_key': image.key,
+        'blob_key': image.blob_key,
+        'content_type': image.content_type,
+        'source_blob_key': image.source_blob_key,
+        'bytes_saved': image.bytes_saved,
+        'urls': [list(style.serving_key()) + [blob.serving_url]
+                 for style, blob in image.blobs.items()],
+    }
+
+
+def import_collections(model, property_name, lines, batch_size=100):
+    """
+    Rebuild the named property of entities of the given model from exported
+    lines. Existing entities keep their other properties, missing entities are
+    created. Only serving URLs that are missing from the records are
+    generated. Returns the number of entities imported.
+
+    """
+
+    count = 0
+    batch = []
+    records = (json.loads(line) for line in lines if line.strip())
+    for path, group in groupby(records, lambda r: tuple(r['key'])):
+        batch.append((db.Key.from_path(*path), list(group)))
+        if len(batch) == batch_size:
+            count += _import_batch(model, property_name, batch)
+            batch = []
+    if batch:
+        count += _import_batch(model, property_name, batch)
+    return count
+
+
+def _import_batch(model, property_name, batch):
+    """Rebuild and put a batch of entities from their records."""
+
+    prop = getattr(model, property_name)
+    entities = db.get([key for key, _ in batch])
+    for i, (key, records) in enumerate(batch):
+        if entities[i] is None:
+            entities[i] = model(key=key)
+        collection = prop.default_value()
+        for record in records:
+            if 'blob_key' in record:
+                collection.add(image_from_record(collection, record))
+        collection.generate_urls()
+        setattr(entities[i], property_name, collection)
+    db.put(entities)
+    return len(entities)
+
+
+def image_from_record(collection, record):
+    """Build an ``Image`` for the given collection from an export record."""
+
+    by_serving_key = dict(
+        [(s.serving_key(), s) for s in collection.styles.values()])
+    image = Image(record['blob_key'], record['content_type'])
+    image.key = str(record.get('image_key', image.blob_key))
+    if record.get('source_blob_key'):
+        image.source_blob_key = str(record['source_blob_key'])
+    image.bytes_saved = record.get('bytes_saved', 0)
+    for image_format, quality, serving_url in record['urls']:
+        style = by_serving_key.get((image_format, quality)) or Style(
+            'imported', format=image_format, quality=quality)
+        image.blobs[style] = \
+            Blob(image.blob_key, image.content_type, serving_url)
+    return image
@@ -5,7 +5,8 @@ Example application for ae_image.
 """
 
 from ae_image.flask_utils import append_from_request
-from flask import Flask, render_template, request, url_for, redirect
+from flask import (
+    Flask, abort, render_template, request, url_for, redirect)
 from google.appengine.ext import db, blobstore
 from werkzeug.urls import url_decode
 import ae_image
@@ -36,12 +37,19 @@ app.wsgi_app = MethodRewriteMiddleware(app.wsgi_app)
 
 
 class NamedCollections(db.Model):
-    """A simple named collection model to demonstrate the use of ae_image."""
+    """
+    A simple named collection model to demonstrate the use of ae_image.
+    Collections saved before the summary was added are listed on the home
+    page once saved again, by ``backfill.start(NamedCollections, 'images',
+    resave=True)``.
+
+    """
 
     name = db.StringProperty()
     images = ae_image.Property([
         ae_image.Style('thumb', size=50, quality=75),
         ae_image.Style('medium', size=300, crop=True)])
+    summary = ae_image.SummaryProperty('images', 'thumb', size=4)
 
     @classmethod
     def get_named(cls, name):
@@ -56,7 +64,7 @@ def home():
 
     return render_template('home.html',
         upload_url=blobstore.create_upload_url(url_for('upload')),
-        collections=list(NamedCollections.all()))
+        collections=list(NamedCollections.all(projection=('summary',))))
 
 
 @app.route('/upload', methods=['POST'])
@@ -66,6 +74,7 @@ def upload():
     collection = NamedCollections.get_named(request.form['name'])
     append_from_request(collection.images, 'images')
     collection.save()
+    collection.images.delete_pending()
     response = redirect(url_for('home'))
     response.data = ''
     return response
@@ -73,10 +82,25 @@ def upload():
 
 @app.route('/collection/<name>/<key>')
 def image(name, key):
-    """Shows an image from a collection."""
+    """Shows an image from a collection, which may still be pending a URL."""
 
-    return render_template('image.html', key=key,
-        collection=NamedCollections.get_named(name))
+    collection = NamedCollections.get_named(name)
+    try:
+        url = collection.images.get_url('original', key)
+    except ae_image.UrlNotFound, _ex:
+        url = None
+    return render_template('image.html', key=key, url=url,
+        collection=collection)
+
+
+@app.route('/collection/<name>/cover/<int:index>')
+def cover(name, index):
+    """Redirects to a cover of a collection whose blob key is not known."""
+
+    keys = NamedCollections.get_named(name).images.images.keys()
+    if index >= len(keys):
+        abort(404)
+    return redirect(url_for('image', name=name, key=keys[index]))
 
 
 @app.route('/collection/<name>/<key>', methods=['DELETE'])
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of how serving URLs are stored in a pickled ``Collection``. The
+blobs of an image usually have the same serving URL, and all URLs share a few
+prefixes. Four forms are compared, to report the effect of sharing the URL
+between the blobs of an image and of the prefix table separately:
+
+- ``full``: a full URL string per blob, as stored before URL tables
+- ``shared``: a full URL string shared by the blobs of an image
+- ``table``: a prefix table, with a suffix string per blob
+- ``both``: a prefix table and suffixes shared by the blobs of an image,
+  as currently stored
+
+For each it reports the stored size and the time to unpickle the collection
+and rebuild every URL.
+
+Usage::
+
+    ./manage bench [options]
+
+"""
+
+import sys
+import os
+sys.path[1:1] = [os.path.abspath(os.path.dirname(__file__) + '/lib')]
+
+from ae_image import segments
+from ae_image.core import Blob, Collection, Image, Style
+from optparse import OptionParser
+import pickle
+import random
+import string
+import time
+
+STYLES = [
+    Style('thumb', size=50, quality=75),
+    Style('medium', size=300, crop=True),
+    Style('low', size=600, format='jpeg', quality=50),
+]
+
+
+def make_urls(count):
+    """Random serving URLs shaped like the ones of the images service."""
+
+    alphabet = string.ascii_letters + string.digits + '-_'
+    return [('http://lh%d.ggpht.com/' % random.randint(3, 6)) +
+            ''.join([random.choice(alphabet) for _ in range(90)])
+            for _ in range(count)]
+
+
+def old_blob(blob_key, serving_url):
+    """A ``Blob`` in the form stored before URL tables were used."""
+
+    blob = Blob.__new__(Blob)
+    blob.__dict__ = {
+        'blob_key': blob_key,
+        'content_type': 'image/jpeg',
+        'serving_url': serving_url,
+    }
+    return blob
+
+
+def old_urls(urls, shared):
+    """A collection of blobs in the old form, storing full URLs."""
+
+    collection = Collection(STYLES)
+    for i, url in enumerate(urls):
+        blob_key = 'blob%08d' % i
+        blobs = {}
+        for style in collection.styles.values():
+            # a new string per blob, like separate images service responses
+            blobs[style] = old_blob(blob_key, shared and url or ''.join(url))
+        image = Image(blob_key, 'image/jpeg', blobs)
+        collection.images[blob_key] = image
+    return collection
+
+
+def full_urls(urls):
+    """A collection storing a full URL string for every blob."""
+
+    return old_urls(urls, False)
+
+
+def shared_urls(urls):
+    """A collection storing a full URL string shared within each image."""
+
+    return old_urls(urls, True)
+
+
+def table_urls(urls):
+    """A collection storing a suffix string for every blob using its table."""
+
+    collection = Collection(STYLES)
+    for i, url in enumerate(urls):
+        blob_key = 'blob%08d' % i
+        image = Image(blob_key, 'image/jpeg', url_table=collection.url_table)
+        for style in collection.styles.values():
+            image.blobs[style] = Blob(blob_key, 'image/jpeg', ''.join(url),
+                                      collection.url_table)
+        collection.add(image)
+    return collection
+
+
+def both_urls(urls):
+    """A collection storing URLs as they are currently stored."""
+
+    collection = Collection(STYLES)
+    for i, url in enumerate(urls):
+        blob_key = 'blob%08d' % i
+        image = Image(blob_key, 'image/jpeg', url_table=collection.url_table)
+        for style in collection.styles.values():
+            image.set_serving_url(style, ''.join(url))
+        collection.add(image)
+    return collection
+
+
+def measure(collection, repeat):
+    """Stored size and best time to load and rebuild all URLs."""
+
+    data = pickle.dumps(collection, segments.PROTOCOL)
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        loaded = pickle.loads(data)
+        for style in loaded.styles.values():
+            for image in loaded.images.values():
+                image.get_url(style)
+        elapsed = time.time() - start
+        best = best is None and elapsed or min(best, elapsed)
+    return len(data), best
+
+
+def main():
+    """Run the benchmark for the requested collection sizes."""
+
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--images', type='int', action='append',
+                      help='number of images, may be repeated')
+    parser.add_option('-r', '--repeat', type='int', default=5,
+                      help='number of times to time loading')
+    options, _ = parser.parse_args()
+
+    random.seed(42)
+    print '%8s  %-6s %12s %10s' % ('images', 'form', 'bytes', 'load ms')
+    for count in options.images or [100, 1000, 10000]:
+        urls = make_urls(count)
+        for name, build in (('full', full_urls), ('shared', shared_urls),
+                            ('table', table_urls), ('both', both_urls)):
+            size, elapsed = measure(build(urls), options.repeat)
+            print '%8d  %-6s %12d %10.2f' % (count, name, size, elapsed * 1000)
+
+
+if __name__ == '__main__':
+    main()
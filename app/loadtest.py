@@ -0,0 +1,415 @@
+# -*- coding: utf-8 -*-
+"""
+Load test for ae_image_app. The application is driven in-process through its
+WSGI interface using the local service stubs, with a configurable number of
+concurrent clients issuing a mix of uploads, views, removes and home page
+requests against either a shared collection or a collection per client.
+
+For every scenario it reports throughput, latency percentiles and the time
+spent per phase: blobstore, datastore, images, pickling the collection,
+rendering templates and the remaining application code. The time of a service
+phase is the wall time during which at least one of its API calls was in
+flight, so concurrent calls are not counted twice. Calls to different services
+may overlap, in which case their phases add up to more than the request.
+
+Usage::
+
+    ./manage loadtest [options] [scenario ...]
+
+The operation mix of the scenarios can be replaced with ``--weights``, for
+example ``--weights upload=1,view=10``. Blobs for uploads are created through
+the files API before a request is timed, so only the upload request itself is
+measured.
+
+"""
+
+from __future__ import with_statement
+import sys
+import os
+sys.path[1:1] = [os.path.abspath(os.path.dirname(__file__) + '/lib')]
+
+from StringIO import StringIO
+from google.appengine.api import apiproxy_stub_map, files
+from google.appengine.ext import testbed
+from optparse import OptionParser
+import ae_image.segments
+import ae_image_app
+import random
+import threading
+import time
+
+# a 1x1 transparent PNG
+PNG = ('\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01'
+       '\x08\x06\x00\x00\x00\x1f\x15\xc4\x89\x00\x00\x00\x0bIDATx\x9cc`\x00'
+       '\x02\x00\x00\x05\x00\x01z^\xab?\x00\x00\x00\x00IEND\xaeB`\x82')
+
+SERVICE_PHASES = {
+    'blobstore': 'blobstore',
+    'file': 'blobstore',
+    'datastore_v3': 'datastore',
+    'images': 'images',
+}
+PHASES = ('blobstore', 'datastore', 'images', 'pickle', 'template', 'app')
+
+OPERATIONS = ('upload', 'view', 'remove', 'home')
+
+# name: (operation weights, shared collection)
+SCENARIOS = {
+    'upload-shared': ({'upload': 1}, True),
+    'upload-separate': ({'upload': 1}, False),
+    'mixed-shared': (
+        {'upload': 2, 'view': 5, 'remove': 1, 'home': 2}, True),
+    'mixed-separate': (
+        {'upload': 2, 'view': 5, 'remove': 1, 'home': 2}, False),
+    'browse': ({'view': 8, 'home': 2}, True),
+}
+
+
+def _call_phases(service):
+    """
+    The phases an API call to a service is recorded in: its own and ``None``
+    for all calls. Calls to other services are part of the app phase.
+
+    """
+
+    if service in SERVICE_PHASES:
+        return (SERVICE_PHASES[service], None)
+    return ()
+
+
+class PhaseTimer(object):
+    """
+    Accumulates the time spent per phase for the request currently being
+    handled by each thread. For API calls the union of the intervals during
+    which calls are in flight is recorded, per phase and for all calls.
+
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def reset(self):
+        """Start recording for a new request on the current thread."""
+
+        self.local.phases = dict([(p, 0.0) for p in PHASES])
+        self.local.in_flight = {}
+        self.local.since = {}
+        self.local.rpc = 0.0
+
+    def pop(self):
+        """Stop recording and return the times for the current thread."""
+
+        phases, self.local.phases = self.local.phases, None
+        return phases
+
+    def add(self, phase, elapsed):
+        """Add time to a phase, if a request is being recorded."""
+
+        phases = getattr(self.local, 'phases', None)
+        if phases is not None:
+            phases[phase] += elapsed
+
+    def rpc_time(self):
+        """Wall time during which a timed API call of the request ran."""
+
+        return self.local.rpc
+
+    def pre_call_hook(self, service, call, request, response):
+        """apiproxy hook marking the start of an API call."""
+        # pylint: disable=W0613
+
+        if getattr(self.local, 'phases', None) is not None:
+            now = time.time()
+            for phase in _call_phases(service):
+                count = self.local.in_flight.get(phase, 0)
+                if not count:
+                    self.local.since[phase] = now
+                self.local.in_flight[phase] = count + 1
+
+    def post_call_hook(self, service, call, request, response):
+        """apiproxy hook marking the end of an API call."""
+        # pylint: disable=W0613
+
+        if getattr(self.local, 'phases', None) is not None:
+            now = time.time()
+            for phase in _call_phases(service):
+                count = self.local.in_flight.get(phase, 0) - 1
+                if count < 0:
+                    # the call started before the request was recorded
+                    continue
+                self.local.in_flight[phase] = count
+                if count:
+                    continue
+                elapsed = now - self.local.since.pop(phase)
+                if phase is None:
+                    self.local.rpc += elapsed
+                else:
+                    self.add(phase, elapsed)
+
+    def wrap(self, phase, function):
+        """Wrap a function to record the time spent in it as a phase."""
+
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(phase, time.time() - start)
+        return timed
+
+    def install(self):
+        """Install the API hooks and wrap the pickle and template phases."""
+
+        hooks = apiproxy_stub_map.apiproxy
+        hooks.GetPreCallHooks().Append('loadtest', self.pre_call_hook)
+        hooks.GetPostCallHooks().Append('loadtest', self.post_call_hook)
+        ae_image.segments.dump = self.wrap('pickle', ae_image.segments.dump)
+        ae_image.segments.load = self.wrap('pickle', ae_image.segments.load)
+        ae_image_app.render_template = self.wrap(
+            'template', ae_image_app.render_template)
+
+
+class Client(object):
+    """A single client issuing requests against the application."""
+
+    def __init__(self, collection, known, lock):
+        self.http = ae_image_app.app.test_client()
+        self.collection = collection
+        self.known = known
+        self.lock = lock
+        self.spare = None
+
+    def prepare(self):
+        """
+        Create a blob for the next upload, unless one is left over. This is
+        not part of the timed request, since in production the blob is
+        written by the blobstore upload handler before the app is called.
+
+        """
+
+        if self.spare is None:
+            file_name = files.blobstore.create(mime_type='image/png')
+            with files.open(file_name, 'a') as blob_file:
+                blob_file.write(PNG)
+            files.finalize(file_name)
+            self.spare = str(files.blobstore.get_blob_key(file_name))
+
+    def upload(self):
+        """Post the prepared blob to the upload handler."""
+
+        blob_key, self.spare = self.spare, None
+
+        # this is what the blobstore upload handler passes on to the app
+        content_type = 'message/external-body; blob-key="%s"' % blob_key
+        response = self.http.post('/upload', data={
+            'name': self.collection,
+            'images': (StringIO(''), 'image.png', content_type),
+        })
+        with self.lock:
+            self.known.append(blob_key)
+        return response
+
+    def view(self):
+        """View a known image, or upload one if there are none."""
+
+        with self.lock:
+            blob_key = self.known and random.choice(self.known)
+        if not blob_key:
+            return self.upload()
+        return self.http.get('/collection/%s/%s' % (
+            self.collection, blob_key))
+
+    def remove(self):
+        """Remove a known image, or upload one if there are none."""
+
+        with self.lock:
+            blob_key = self.known and self.known.pop(
+                random.randrange(len(self.known)))
+        if not blob_key:
+            return self.upload()
+        return self.http.post('/collection/%s/%s?_method=DELETE' % (
+            self.collection, blob_key))
+
+    def home(self):
+        """Load the home page."""
+
+        return self.http.get('/')
+
+
+class Result(object):
+    """Measurements for a single request."""
+
+    def __init__(self, operation, elapsed, phases, ok):
+        self.operation = operation
+        self.elapsed = elapsed
+        self.phases = phases
+        self.ok = ok
+
+
+def percentile(values, fraction):
+    """Nearest rank percentile of a sorted list of values."""
+
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def parse_weights(value):
+    """
+    Parse operation weights given as ``operation=weight`` pairs separated by
+    commas. Raises ``ValueError`` for an unknown operation or a bad weight.
+
+    """
+
+    weights = {}
+    for item in value.split(','):
+        operation, _, weight = item.partition('=')
+        operation = operation.strip()
+        if operation not in OPERATIONS:
+            raise ValueError('Unknown operation "%s".' % operation)
+        weights[operation] = int(weight)
+        if weights[operation] < 0:
+            raise ValueError('Negative weight for "%s".' % operation)
+    if not sum(weights.values()):
+        raise ValueError('At least one weight must be positive.')
+    return weights
+
+
+def run_scenario(name, timer, concurrency, requests, weights=None):
+    """
+    Run the named scenario and return the results and wall time. The given
+    operation ``weights`` replace those of the scenario.
+
+    """
+
+    scenario_weights, shared = SCENARIOS[name]
+    weights = weights or scenario_weights
+    choices = []
+    for operation, weight in sorted(weights.items()):
+        choices.extend([operation] * weight)
+
+    results = []
+    shared_known = []
+    lock = threading.Lock()
+
+    def worker(index):
+        if shared:
+            client = Client(name, shared_known, lock)
+        else:
+            client = Client('%s-%d' % (name, index), [], lock)
+        for _ in range(requests):
+            operation = random.choice(choices)
+            client.prepare()
+            timer.reset()
+            start = time.time()
+            try:
+                response = getattr(client, operation)()
+                ok = response.status_code < 400
+            except Exception:  # pylint: disable=W0703
+                ok = False
+            elapsed = time.time() - start
+            rpc = timer.rpc_time()
+            phases = timer.pop()
+            phases['app'] = (elapsed - rpc - phases['pickle'] -
+                             phases['template'])
+            with lock:
+                results.append(Result(operation, elapsed, phases, ok))
+
+    threads = [threading.Thread(target=worker, args=(i,))
+               for i in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.time() - start
+
+
+def report(name, results, wall):
+    """Print the measurements for a scenario."""
+
+    latencies = sorted([r.elapsed for r in results])
+    errors = len([r for r in results if not r.ok])
+    print '%s: %d requests, %d errors, %.1f req/s' % (
+        name, len(results), errors, len(results) / wall)
+    print '  latency ms: p50 %.1f  p95 %.1f  p99 %.1f' % (
+        percentile(latencies, 0.50) * 1000,
+        percentile(latencies, 0.95) * 1000,
+        percentile(latencies, 0.99) * 1000)
+
+    operations = sorted(set([r.operation for r in results]))
+    for operation in operations:
+        subset = [r for r in results if r.operation == operation]
+        times = sorted([r.elapsed for r in subset])
+        print '  %-8s n=%-5d p50 %.1f  p95 %.1f  p99 %.1f' % (
+            operation, len(subset),
+            percentile(times, 0.50) * 1000,
+            percentile(times, 0.95) * 1000,
+            percentile(times, 0.99) * 1000)
+
+    total = sum([r.elapsed for r in results]) or 1.0
+    print '  phases (mean ms per request, share of time):'
+    for phase in PHASES:
+        spent = sum([r.phases[phase] for r in results])
+        print '    %-10s %8.2f  %5.1f%%' % (
+            phase, spent * 1000 / max(1, len(results)), spent * 100 / total)
+
+
+def setup_testbed():
+    """Activate the local service stubs."""
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.setup_env(SERVER_SOFTWARE='Development/loadtest')
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    bed.init_blobstore_stub()
+    bed.init_files_stub()
+    bed.init_images_stub()
+    return bed
+
+
+def main():
+    """Run the requested scenarios and print a report for each."""
+
+    parser = OptionParser(
+        usage='%prog [options] [scenario ...]',
+        description='Scenarios: ' + ', '.join(sorted(SCENARIOS)))
+    parser.add_option('-c', '--concurrency', type='int', default=8,
+                      help='number of concurrent clients')
+    parser.add_option('-n', '--requests', type='int', default=50,
+                      help='number of requests per client')
+    parser.add_option('-s', '--seed', type='int', default=None,
+                      help='random seed for the operation mix')
+    parser.add_option('-w', '--weights', default=None,
+                      help='operation mix replacing that of the scenarios, '
+                           'e.g. upload=1,view=10 (operations: %s)' %
+                           ', '.join(OPERATIONS))
+    options, names = parser.parse_args()
+    weights = None
+    if options.weights:
+        try:
+            weights = parse_weights(options.weights)
+        except ValueError, ex:
+            parser.error(str(ex))
+    names = names or sorted(SCENARIOS)
+    for name in names:
+        if name not in SCENARIOS:
+            parser.error('Unknown scenario "%s".' % name)
+
+    random.seed(options.seed)
+    bed = setup_testbed()
+    ae_image_app.app.config['TESTING'] = True
+    timer = PhaseTimer()
+    timer.install()
+    try:
+        for name in names:
+            results, wall = run_scenario(
+                name, timer, options.concurrency, options.requests, weights)
+            report(name, results, wall)
+    finally:
+        bed.deactivate()
+
+
+if __name__ == '__main__':
+    main()
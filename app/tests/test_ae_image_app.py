@@ -6,6 +6,8 @@ Helpers for unit tests for ae_image.
 # pylint: disable=C0111
 
 from ae_image_test import BaseTestCase
+import ae_image
+import ae_image_app
 
 
 class AppTestCase(BaseTestCase):
@@ -13,3 +15,32 @@ class AppTestCase(BaseTestCase):
         response = self.client.get('/')
         self.assert200(response)
         self.assertTemplateUsed('home.html')
+
+    def test_home_page_lists_collection_summaries(self):
+        collection = ae_image_app.NamedCollections.get_named('main')
+        collection.images.append('abc', 'image/jpeg')
+        collection.save()
+        response = self.client.get('/')
+        self.assert200(response)
+        self.assertTrue('main (1 images)' in response.data,
+            'Expect collection name and image count.')
+
+    def test_pending_image_page_renders(self):
+        collection = ae_image_app.NamedCollections.get_named('main')
+        collection.images.add(ae_image.core.Image('pending', 'image/jpeg'))
+        collection.save()
+        response = self.client.get('/collection/main/pending')
+        self.assert200(response)
+        self.assertTrue('still being processed' in response.data,
+            'Expect the image to be shown as pending.')
+
+    def test_cover_redirects_to_image(self):
+        collection = ae_image_app.NamedCollections.get_named('main')
+        collection.images.append('abc', 'image/jpeg')
+        collection.images.append('def', 'image/jpeg')
+        collection.save()
+        response = self.client.get('/collection/main/cover/1')
+        self.assertStatus(response, 302)
+        self.assertTrue(response.location.endswith('/collection/main/def'),
+            'Expect a redirect to the second image.')
+        self.assert404(self.client.get('/collection/main/cover/2'))
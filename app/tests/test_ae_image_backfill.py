@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Unit tests for ae_image.backfill.
+
+"""
+# pylint: disable=C0111
+
+from ae_image_test import BaseTestCase
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import db, deferred
+import ae_image
+import ae_image.backfill
+import base64
+
+
+class TestBackfillAlbum(db.Model):
+    images = ae_image.Property([ae_image.Style('thumb', size=50)])
+
+
+class TestLegacyAlbum(db.Model):
+    """
+    TestResavedAlbum as it was before the summary was added. It is defined
+    first, so entities of the kind are loaded as TestResavedAlbum.
+
+    """
+
+    images = ae_image.Property([ae_image.Style('thumb', size=50)])
+
+    @classmethod
+    def kind(cls):
+        return 'TestResavedAlbum'
+
+
+class TestResavedAlbum(db.Model):
+    images = ae_image.Property([ae_image.Style('thumb', size=50)])
+    summary = ae_image.SummaryProperty('images', 'thumb')
+
+
+class _BrokenRpc(object):
+    def get_result(self):
+        raise ae_image.serving.images.InvalidBlobKeyError()
+
+
+def _broken_get_serving_url_async(blob_key, rpc=None):
+    # pylint: disable=W0613
+    return _BrokenRpc()
+
+
+# blob key to append from the images service hook, as if in another request
+_concurrent = {'blob_key': None}
+
+
+def _concurrent_append_hook(service, call, request, response):
+    # pylint: disable=W0613
+    blob_key, _concurrent['blob_key'] = _concurrent['blob_key'], None
+    if blob_key:
+        album = TestBackfillAlbum.get_by_key_name('album0')
+        album.images.add(ae_image.core.Image(blob_key, 'image/jpeg'))
+        album.save()
+
+
+def run_tasks(prefix, queue_name='default'):
+    """Run the queued tasks with names starting with prefix, in order."""
+
+    stub = apiproxy_stub_map.apiproxy.GetStub('taskqueue')
+    names = []
+    while True:
+        tasks = [task for task in stub.GetTasks(queue_name)
+                 if task['name'].startswith(prefix)]
+        if not tasks:
+            return names
+        for task in tasks:
+            stub.DeleteTask(queue_name, task['name'])
+            names.append(task['name'])
+            deferred.run(base64.b64decode(task['body']))
+
+
+class BackfillTestCase(BaseTestCase):
+    def test_split_ranges(self):
+        ranges = ae_image.backfill.split_ranges(range(10), 3)
+        self.assertEqual(ranges, [(None, 3), (3, 6), (6, None)],
+            'Expect 3 ranges.')
+
+    def test_split_ranges_with_few_keys(self):
+        self.assertEqual(ae_image.backfill.split_ranges([], 3),
+            [(None, None)], 'Expect a single unbounded range.')
+        self.assertEqual(ae_image.backfill.split_ranges([5], 3),
+            [(None, 5), (5, None)], 'Expect 2 ranges.')
+
+    def test_run_shard_generates_missing_urls(self):
+        for i in range(5):
+            album = TestBackfillAlbum(key_name='album%d' % i)
+            album.images.append('abc%d' % i, 'image/jpeg')
+            album.save()
+
+        style = ae_image.Style('low', format='jpeg', quality=50)
+        TestBackfillAlbum.images.styles.append(style)
+        try:
+            shards = ae_image.backfill.plan(TestBackfillAlbum, 'job', 1)
+            self.assertEqual(len(shards), 1, 'Expect a single shard.')
+            ae_image.backfill.run_shard(TestBackfillAlbum, 'images',
+                shards[0].key().name(), batch_size=2, batches_per_task=10)
+
+            progress = ae_image.backfill.progress('job')
+            self.assertEqual(progress['done'], 1, 'Expect shard to be done.')
+            self.assertEqual(progress['processed'], 5,
+                'Expect all entities to be processed.')
+            self.assertEqual(progress['updated'], 5,
+                'Expect all entities to be updated.')
+
+            for album in TestBackfillAlbum.all():
+                self.assertTrue(
+                    album.images.get_url('low', album.images.images.keys()[0]),
+                    'Expect URL for new style.')
+        finally:
+            TestBackfillAlbum.images.styles.remove(style)
+
+    def test_process_batch_checkpoints(self):
+        for i in range(3):
+            TestBackfillAlbum(key_name='album%d' % i).save()
+        shard = ae_image.backfill.plan(TestBackfillAlbum, 'job', 1)[0]
+        ae_image.backfill.process_batch(TestBackfillAlbum, 'images', shard, 2)
+        shard = ae_image.backfill.BackfillShard.get_by_key_name(
+            shard.key().name())
+        self.assertFalse(shard.done, 'Expect shard to be in progress.')
+        self.assertEqual(shard.processed, 2, 'Expect 2 processed.')
+        self.assertTrue(shard.cursor, 'Expect a cursor.')
+
+    def test_process_batch_keeps_concurrent_changes(self):
+        album = TestBackfillAlbum(key_name='album0')
+        album.images.append('abc', 'image/jpeg')
+        album.save()
+
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'ae_image_concurrent', _concurrent_append_hook, 'images')
+        _concurrent['blob_key'] = 'def'
+        style = ae_image.Style('low', format='jpeg', quality=50)
+        TestBackfillAlbum.images.styles.append(style)
+        try:
+            shard = ae_image.backfill.plan(TestBackfillAlbum, 'job', 1)[0]
+            ae_image.backfill.process_batch(
+                TestBackfillAlbum, 'images', shard, 10)
+        finally:
+            _concurrent['blob_key'] = None
+            TestBackfillAlbum.images.styles.remove(style)
+
+        album = TestBackfillAlbum.get_by_key_name('album0')
+        self.assertEqual(album.images.images.keys(), ['abc', 'def'],
+            'Expect the concurrently appended image to be kept.')
+        self.assertTrue(album.images.get_url('low', 'abc'),
+            'Expect URL for new style.')
+
+    def test_resave_writes_summaries(self):
+        album = TestLegacyAlbum(key_name='album0')
+        album.images.append('abc', 'image/jpeg')
+        album.save()
+        self.assertFalse(
+            TestResavedAlbum.all(projection=('summary',)).fetch(10),
+            'Expect no summary for an album saved before it was added.')
+
+        shard = ae_image.backfill.plan(TestResavedAlbum, 'job', 1)[0]
+        ae_image.backfill.process_batch(
+            TestResavedAlbum, 'images', shard, 10, resave=True)
+        albums = TestResavedAlbum.all(projection=('summary',)).fetch(10)
+        self.assertEqual(len(albums), 1, 'Expect the album to be listed.')
+        self.assertEqual(albums[0].summary.count, 1, 'Expect 1 image.')
+
+    def test_start_runs_through_deferred(self):
+        for i in range(5):
+            album = TestBackfillAlbum(key_name='album%d' % i)
+            album.images.append('abc%d' % i, 'image/jpeg')
+            album.save()
+
+        style = ae_image.Style('low', format='jpeg', quality=50)
+        TestBackfillAlbum.images.styles.append(style)
+        try:
+            job_id = ae_image.backfill.start(TestBackfillAlbum, 'images',
+                shards=1, batch_size=2, batches_per_task=1)
+            names = run_tasks(job_id)
+        finally:
+            TestBackfillAlbum.images.styles.remove(style)
+
+        self.assertEqual(names, ['%s-0-%d' % (job_id, i) for i in range(3)],
+            'Expect a chain of 3 named tasks.')
+        progress = ae_image.backfill.progress(job_id)
+        self.assertEqual(progress['done'], 1, 'Expect shard to be done.')
+        self.assertEqual(progress['updated'], 5,
+            'Expect all entities to be updated.')
+
+    def test_retried_task_does_not_fork_the_chain(self):
+        for i in range(3):
+            TestBackfillAlbum(key_name='album%d' % i).save()
+        shard = ae_image.backfill.plan(TestBackfillAlbum, 'retry', 1)[0]
+        for _ in range(2):
+            ae_image.backfill.run_shard(TestBackfillAlbum, 'images',
+                shard.key().name(), batch_size=1, batches_per_task=1)
+
+        stub = apiproxy_stub_map.apiproxy.GetStub('taskqueue')
+        names = [task['name'] for task in stub.GetTasks('default')
+                 if task['name'].startswith('retry')]
+        self.assertEqual(names, ['retry-0-1'],
+            'Expect a single task to continue the chain.')
+        run_tasks('retry')
+
+    def test_permanent_errors_do_not_stall_the_shard(self):
+        for i in range(3):
+            album = TestBackfillAlbum(key_name='album%d' % i)
+            album.images.add(ae_image.core.Image('abc%d' % i, 'image/jpeg'))
+            album.save()
+
+        shard = ae_image.backfill.plan(TestBackfillAlbum, 'broken', 1)[0]
+        images = ae_image.serving.images
+        original = images.get_serving_url_async
+        images.get_serving_url_async = _broken_get_serving_url_async
+        try:
+            ae_image.backfill.run_shard(TestBackfillAlbum, 'images',
+                shard.key().name(), batch_size=2, batches_per_task=10)
+        finally:
+            images.get_serving_url_async = original
+
+        progress = ae_image.backfill.progress('broken')
+        self.assertEqual(progress['done'], 1, 'Expect shard to be done.')
+        self.assertEqual(progress['processed'], 3,
+            'Expect all entities to be processed.')
+        self.assertEqual(progress['failed'], 3,
+            'Expect the URL to fail for each image.')
@@ -8,6 +8,18 @@ Unit tests for ae_image.core.
 from ae_image_test import BaseTestCase
 from google.appengine.ext.blobstore import BlobInfo
 import ae_image.core
+import pickle
+import struct
+
+
+def make_bmp(width, height):
+    """A white 24 bit BMP of the given size."""
+
+    row = '\xff' * (width * 3) + '\x00' * ((4 - width * 3 % 4) % 4)
+    pixels = row * height
+    return ('BM' + struct.pack('<IHHI', 54 + len(pixels), 0, 0, 54) +
+            struct.pack('<IiiHHIIiiII', 40, width, height, 1, 24, 0,
+                        len(pixels), 2835, 2835, 0, 0) + pixels)
 
 
 class StyleTestCase(BaseTestCase):
@@ -66,6 +78,92 @@ class StyleTestCase(BaseTestCase):
             'Expect repr back.')
 
 
+class ConversionTestCase(BaseTestCase):
+    def test_unknown_format(self):
+        self.assertRaises(ValueError, ae_image.core.Conversion, format='gif')
+
+    def test_other_content_types_are_not_converted(self):
+        blob_key = self.make_blob('image/png', 'dummy')
+        image = ae_image.core.Image(blob_key, 'image/png')
+        self.assertFalse(ae_image.core.Conversion().convert(image),
+            'Expect PNG to not be converted.')
+        self.assertEqual(image.blob_key, str(blob_key),
+            'Expect image to be unchanged.')
+
+    def test_bmp_is_converted_to_png(self):
+        blob_key = self.make_blob('image/bmp', make_bmp(32, 32))
+        collection = ae_image.core.Collection(
+            [ae_image.core.Style('big', 500)],
+            conversion=ae_image.core.Conversion())
+        collection.append_from_blob_info(BlobInfo.get(blob_key))
+        image = collection.images.values()[0]
+        self.assertNotEqual(image.blob_key, str(blob_key),
+            'Expect a new blob.')
+        self.assertEqual(image.content_type, 'image/png', 'Expect a PNG.')
+        self.assertTrue(collection.bytes_saved > 0, 'Expect bytes saved.')
+        self.assertTrue(BlobInfo.get(blob_key),
+            'Expect the source blob to be kept until saved.')
+        self.assertEqual(collection.delete_pending(), [str(blob_key)],
+            'Expect the source blob to be pending deletion.')
+        self.assertFalse(BlobInfo.get(blob_key),
+            'Expect the source blob to be deleted.')
+        self.assertTrue(collection.get_url('big', blob_key),
+            'Expect URL back for the uploaded blob key.')
+
+        collection.remove(blob_key)
+        self.assertEqual(collection.images.keys(), [],
+            'Expect image removed by the uploaded blob key.')
+        self.assertFalse(BlobInfo.get(image.blob_key),
+            'Expect the converted blob to be deleted.')
+
+    def test_undecodable_image_is_not_converted(self):
+        blob_key = self.make_blob('image/bmp', 'dummy')
+        image = ae_image.core.Image(blob_key, 'image/bmp')
+        self.assertFalse(ae_image.core.Conversion().convert(image, 5),
+            'Expect no conversion.')
+        self.assertEqual(image.blob_key, str(blob_key),
+            'Expect image to be unchanged.')
+
+    def test_tiff_is_not_converted_by_default(self):
+        conversion = ae_image.core.Conversion()
+        self.assertFalse('image/tiff' in conversion.content_types,
+            'Expect TIFF to be left out.')
+
+    def test_source_is_kept(self):
+        blob_key = self.make_blob('image/bmp', make_bmp(32, 32))
+        image = ae_image.core.Image(blob_key, 'image/bmp')
+        conversion = ae_image.core.Conversion(keep_source=True)
+        self.assertTrue(conversion.convert(image), 'Expect a conversion.')
+        self.assertEqual(image.source_blob_key, str(blob_key),
+            'Expect the source blob key to be kept.')
+        self.assertTrue(str(blob_key) in image.blob_keys(),
+            'Expect the source to be referenced by the image.')
+        image.remove()
+        self.assertFalse(BlobInfo.get(blob_key),
+            'Expect the source blob to be removed with the image.')
+
+
+class UrlTableTestCase(BaseTestCase):
+    def test_split_and_join(self):
+        table = ae_image.core.UrlTable()
+        index, suffix = table.split('http://lh3.ggpht.com/abc')
+        self.assertEqual(suffix, 'abc', 'Expect unique suffix.')
+        self.assertEqual(table.join(index, suffix), 'http://lh3.ggpht.com/abc',
+            'Expect URL to be rebuilt.')
+        self.assertEqual(table.split('http://lh3.ggpht.com/def')[0], index,
+            'Expect the same prefix index.')
+        self.assertNotEqual(table.split('http://lh4.ggpht.com/def')[0], index,
+            'Expect a different prefix index.')
+        self.assertEqual(len(table.prefixes), 2, 'Expect 2 prefixes.')
+
+    def test_index_is_rebuilt_after_unpickling(self):
+        table = ae_image.core.UrlTable()
+        index, _ = table.split('http://lh3.ggpht.com/abc')
+        table = pickle.loads(pickle.dumps(table))
+        self.assertEqual(table.split('http://lh3.ggpht.com/def')[0], index,
+            'Expect the same prefix index.')
+
+
 class BlobTestCase(BaseTestCase):
     def test_repr_has_something(self):
         self.assertEqual(
@@ -73,8 +171,32 @@ class BlobTestCase(BaseTestCase):
             repr(ae_image.core.Blob('key', 'jpeg', 'url')),
             'Expect repr back.')
 
+    def test_url_with_table(self):
+        table = ae_image.core.UrlTable()
+        blob = ae_image.core.Blob('key', 'jpeg', 'http://host/abc', table)
+        self.assertEqual(blob.serving_url, 'http://host/abc',
+            'Expect the full URL back.')
+        self.assertEqual(table.prefixes, ['http://host/'],
+            'Expect the prefix in the table.')
+
+    def test_stored_without_table(self):
+        blob = ae_image.core.Blob.__new__(ae_image.core.Blob)
+        blob.__setstate__({'blob_key': 'key', 'content_type': 'jpeg',
+                           'serving_url': 'http://host/abc'})
+        self.assertEqual(blob.serving_url, 'http://host/abc',
+            'Expect the full URL back.')
+        blob.set_url_table(ae_image.core.UrlTable())
+        self.assertEqual(blob.serving_url, 'http://host/abc',
+            'Expect the full URL back after moving it to a table.')
+
 
 class ImageTestCase(BaseTestCase):
+    def test_stored_without_key(self):
+        image = ae_image.core.Image.__new__(ae_image.core.Image)
+        image.__setstate__({'blob_key': 'abc', 'content_type': 'jpeg',
+                            'blobs': {}})
+        self.assertEqual(image.key, 'abc', 'Expect the blob key as key.')
+
     def test_empty_image_has_no_url(self):
         image = ae_image.core.Image('abc', 'jpeg')
         self.assertEqual(len(image.blobs), 0,
@@ -236,6 +358,51 @@ class CollectionTestCase(BaseTestCase):
         self.assertRaises(ae_image.core.UnknownImage, collection.remove,
             blob_key)
 
+    def test_changes_are_tracked(self):
+        blob_key = str(self.make_blob('image/jpeg', 'dummy'))
+        collection = ae_image.core.Collection(
+            [ae_image.core.Style('big', 500)])
+        collection.append(blob_key, 'jpeg')
+        collection.append('def', 'jpeg')
+        collection.remove(blob_key)
+        collection.styles['low'] = ae_image.core.Style('low', format='jpeg')
+        collection.generate_urls()
+        changes = collection.pop_changes()
+        self.assertEqual([op for op, _ in changes],
+            ['append', 'append', 'remove', 'update'],
+            'Expect changes in order.')
+        self.assertEqual(collection.pop_changes(), [],
+            'Expect changes to be forgotten once popped.')
+
+        replica = ae_image.core.Collection(collection.styles.values())
+        replica.apply_changes(changes)
+        self.assertEqual(replica.images.keys(), ['def'],
+            'Expect replayed changes to result in the same images.')
+        self.assertTrue(replica.get_url('low', 'def'),
+            'Expect replayed update to include the new URL.')
+
+    def test_url_table_is_shared(self):
+        collection = ae_image.core.Collection(
+            [ae_image.core.Style('big', 500)])
+        collection.append('abc', 'jpeg')
+        collection.add(ae_image.core.Image('def', 'jpeg', {
+            ae_image.core.Style('original'):
+                ae_image.core.Blob('def', 'jpeg', '/_ah/img/def')}))
+        collection = pickle.loads(pickle.dumps(collection))
+        for image in collection.images.values():
+            for blob in image.blobs.values():
+                self.assertTrue(blob.url_table is collection.url_table,
+                    'Expect blobs to use the collection URL table.')
+        self.assertEqual(collection.get_url('original', 'def'),
+            '/_ah/img/def', 'Expect the full URL back.')
+
+    def test_changes_are_not_pickled(self):
+        collection = ae_image.core.Collection([])
+        collection.append('abc', 'jpeg')
+        collection = pickle.loads(pickle.dumps(collection))
+        self.assertEqual(collection.pop_changes(), [],
+            'Expect no changes on an unpickled collection.')
+
     def test_repr_has_something(self):
         expected = '''Collection:
 styles: {'original': <Style "original">, 'another': <Style "another">}
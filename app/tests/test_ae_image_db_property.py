@@ -16,6 +16,11 @@ class TestAlbum(db.Model):
         ae_image.Style('medium', size=300, quality=85)])
 
 
+class TestSummarizedAlbum(db.Model):
+    images = ae_image.Property([ae_image.Style('thumb', size=50)])
+    summary = ae_image.SummaryProperty('images', 'thumb', size=2)
+
+
 class CollectionPropertyTestCase(BaseTestCase):
     def test_default_property_value(self):
         album = TestAlbum()
@@ -84,3 +89,142 @@ class CollectionPropertyTestCase(BaseTestCase):
     def test_property_must_be_collection(self):
         album = TestAlbum()
         self.assertRaises(db.BadValueError, setattr, album, 'images', 'abc')
+
+    def test_save_appends_delta(self):
+        album_key = 'test_save_appends_delta'
+        album = TestAlbum(key_name=album_key)
+        album.images.append('abc', 'image/jpeg')
+        album.save()
+
+        album = TestAlbum.get_by_key_name(album_key)
+        album.images.append('def', 'image/jpeg')
+        album.save()
+
+        album = TestAlbum.get_by_key_name(album_key)
+        self.assertEqual(len(album.images.stored_segments), 2,
+            'Expect a snapshot and a single delta.')
+        self.assertEqual(album.images.images.keys(), ['abc', 'def'],
+            'Expect both images in order.')
+
+    def test_save_without_changes_writes_same_segments(self):
+        album = TestAlbum(key_name='test_save_without_changes')
+        album.images.append('abc', 'image/jpeg')
+        first = TestAlbum.images.get_value_for_datastore(album)
+        second = TestAlbum.images.get_value_for_datastore(album)
+        self.assertEqual(first, second, 'Expect the same segments.')
+
+    def test_deltas_are_compacted(self):
+        class TestAlbumAlt(db.Model):
+            images = ae_image.Property(
+                [ae_image.Style('thumb', size=50, quality=75)],
+                max_deltas=2, max_delta_ratio=100)
+
+        album_key = 'test_deltas_are_compacted'
+        album = TestAlbumAlt(key_name=album_key)
+        album.save()
+        for blob_key in ('abc', 'def'):
+            album = TestAlbumAlt.get_by_key_name(album_key)
+            album.images.append(blob_key, 'image/jpeg')
+            album.save()
+
+        album = TestAlbumAlt.get_by_key_name(album_key)
+        self.assertEqual(len(album.images.stored_segments) - 1, 2,
+            'Expect up to max_deltas deltas to be kept.')
+
+        album.images.append('ghi', 'image/jpeg')
+        album.save()
+        album = TestAlbumAlt.get_by_key_name(album_key)
+        self.assertEqual(len(album.images.stored_segments), 1,
+            'Expect deltas to be compacted into a snapshot.')
+        self.assertEqual(album.images.images.keys(), ['abc', 'def', 'ghi'],
+            'Expect all images in order.')
+
+
+    def test_deltas_are_compacted_over_max_bytes(self):
+        class TestAlbumAlt(db.Model):
+            images = ae_image.Property(
+                [ae_image.Style('thumb', size=50, quality=75)],
+                max_delta_ratio=100, max_bytes=1)
+
+        album_key = 'test_deltas_are_compacted_over_max_bytes'
+        TestAlbumAlt(key_name=album_key).save()
+        album = TestAlbumAlt.get_by_key_name(album_key)
+        album.images.append('abc', 'image/jpeg')
+        album.save()
+
+        album = TestAlbumAlt.get_by_key_name(album_key)
+        self.assertEqual(len(album.images.stored_segments), 1,
+            'Expect a snapshot instead of a delta over max_bytes.')
+
+
+class SummaryPropertyTestCase(BaseTestCase):
+    def test_summary_is_updated_on_save(self):
+        album = TestSummarizedAlbum(key_name='test_summary_is_updated')
+        for blob_key in ('abc', 'def', 'ghi'):
+            album.images.append(blob_key, 'image/jpeg')
+        album.save()
+
+        album = TestSummarizedAlbum.get_by_key_name('test_summary_is_updated')
+        self.assertEqual(album.summary.count, 3, 'Expect 3 images.')
+        self.assertEqual(album.summary.version, 3, 'Expect version 3.')
+        self.assertEqual(album.summary.covers(),
+            [('abc', album.images.get_url('thumb', 'abc')),
+             ('def', album.images.get_url('thumb', 'def'))],
+            'Expect the first 2 images as covers.')
+
+        album.images.append('jkl', 'image/jpeg')
+        album.save()
+        album = TestSummarizedAlbum.get_by_key_name('test_summary_is_updated')
+        self.assertEqual(album.summary.count, 4, 'Expect 4 images.')
+        self.assertEqual(album.summary.version, 4, 'Expect version 4.')
+
+    def test_summary_projection_query(self):
+        album = TestSummarizedAlbum(key_name='test_summary_projection_query')
+        album.images.append('abc', 'image/jpeg')
+        album.save()
+
+        albums = TestSummarizedAlbum.all(projection=('summary',)).fetch(10)
+        self.assertEqual(len(albums), 1, 'Expect a single album.')
+        self.assertEqual(albums[0].summary.count, 1, 'Expect 1 image.')
+
+    def test_summary_is_truncated_to_fit(self):
+        class TestAlbumAlt(db.Model):
+            images = ae_image.Property([ae_image.Style('thumb', size=50)])
+            summary = ae_image.SummaryProperty('images', 'thumb', size=100)
+
+        album = TestAlbumAlt()
+        for i in range(20):
+            album.images.append('%040d' % i, 'image/jpeg')
+        value = TestAlbumAlt.summary.get_value_for_datastore(album)
+        self.assertTrue(len(value) <= 500, 'Expect summary to fit.')
+        self.assertEqual(album.summary.count, 20, 'Expect 20 images.')
+        self.assertTrue(0 < len(album.summary.covers()) < 20,
+            'Expect fewer covers.')
+
+    def test_summary_keeps_covers_over_blob_keys(self):
+        class TestAlbumAlt(db.Model):
+            images = ae_image.Property([ae_image.Style('thumb', size=50)])
+            summary = ae_image.SummaryProperty('images', 'thumb', size=4)
+
+        album = TestAlbumAlt()
+        blob_keys = ['%090d' % i for i in range(4)]
+        for blob_key in blob_keys:
+            album.images.append(blob_key, 'image/jpeg')
+        value = TestAlbumAlt.summary.get_value_for_datastore(album)
+        self.assertTrue(len(value) <= 500, 'Expect summary to fit.')
+
+        summary = TestAlbumAlt.summary.make_value_from_datastore(value)
+        self.assertEqual([url for _, url in summary.covers()],
+            [album.images.get_url('thumb', b) for b in blob_keys],
+            'Expect the URLs of all 4 covers.')
+        self.assertTrue(None in [key for key, _ in summary.covers()],
+            'Expect blob keys to be dropped before covers.')
+
+    def test_summary_of_no_collection(self):
+        album = TestSummarizedAlbum(key_name='test_summary_of_no_collection')
+        album.images = None
+        album.save()
+
+        album = TestSummarizedAlbum.get_by_key_name(
+            'test_summary_of_no_collection')
+        self.assertEqual(album.summary.count, 0, 'Expect an empty summary.')
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Unit tests for ae_image.ndb_property.
+
+"""
+# pylint: disable=C0111
+
+from ae_image_test import BaseTestCase
+from google.appengine.ext import blobstore, db, ndb
+import ae_image
+import ae_image.ndb_property
+import pickle
+
+
+class TestNdbAlbum(ndb.Model):
+    images = ae_image.ndb_property.Property([
+        ae_image.Style('thumb', size=50, quality=75),
+        ae_image.Style('medium', size=300, quality=85)])
+
+
+class TestMovedAlbum(ndb.Model):
+    images = ae_image.ndb_property.Property(
+        [ae_image.Style('thumb', size=50)])
+
+
+class TestDbMovedAlbum(db.Model):
+    """TestMovedAlbum as stored using the db property."""
+
+    images = ae_image.Property([ae_image.Style('thumb', size=50)])
+
+    @classmethod
+    def kind(cls):
+        return 'TestMovedAlbum'
+
+
+class TestMovedLegacyAlbum(ndb.Model):
+    images = ae_image.ndb_property.Property(
+        [ae_image.Style('thumb', size=50)])
+
+
+class TestDbMovedLegacyAlbum(db.Model):
+    """TestMovedLegacyAlbum as stored before segments were used."""
+
+    images = db.BlobProperty()
+
+    @classmethod
+    def kind(cls):
+        return 'TestMovedLegacyAlbum'
+
+
+class NdbPropertyTestCase(BaseTestCase):
+    def test_default_property_value(self):
+        album = TestNdbAlbum()
+        self.assertTrue(
+            isinstance(album.images, ae_image.core.Collection),
+            'Expect default value to be a Collection instance.')
+
+    def test_property_must_be_collection(self):
+        album = TestNdbAlbum()
+        self.assertRaises(ndb.BadValueError, setattr, album, 'images', 'abc')
+
+    def test_store_and_restore(self):
+        blob_key = self.make_blob('image/jpeg', 'dummy')
+        album = TestNdbAlbum(id='test_store_and_restore')
+        ae_image.ndb_property.append_async(
+            album.images, blob_key, 'image/jpeg').get_result()
+        album_key = album.put()
+
+        ndb.get_context().clear_cache()
+        album = album_key.get(use_memcache=False)
+        self.assertTrue(
+            album.images.get_url('thumb', blob_key), 'Expect URL back.')
+
+        album.images.append('def', 'image/jpeg')
+        album.put()
+        ndb.get_context().clear_cache()
+        album = album_key.get(use_memcache=False)
+        self.assertEqual(len(album.images.stored_segments), 2,
+            'Expect a snapshot and a single delta.')
+
+    def test_generate_urls_async_for_new_style(self):
+        album = TestNdbAlbum()
+        ae_image.ndb_property.append_async(
+            album.images, 'abc', 'image/jpeg').get_result()
+        self.assertFalse(
+            ae_image.ndb_property.generate_urls_async(
+                album.images).get_result(),
+            'Expect nothing to generate.')
+        album.images.styles['low'] = ae_image.Style('low', format='jpeg')
+        self.assertTrue(
+            ae_image.ndb_property.generate_urls_async(
+                album.images).get_result(),
+            'Expect to generate something.')
+        self.assertTrue(
+            album.images.get_url('low', 'abc'), 'Expect URL back.')
+
+    def test_remove_async(self):
+        blob_key = self.make_blob('image/jpeg', 'dummy')
+        album = TestNdbAlbum()
+        ae_image.ndb_property.append_async(
+            album.images, blob_key, 'image/jpeg').get_result()
+        ae_image.ndb_property.remove_async(
+            album.images, blob_key).get_result()
+        self.assertFalse(blobstore.BlobInfo.get(blob_key),
+            'Should no longer be able to load BlobInfo for key.')
+        self.assertRaises(ae_image.core.UnknownImage,
+            album.images.get_url, 'thumb', blob_key)
+
+    def test_batch_deadline_leaves_image_pending(self):
+        collection = ae_image.Collection(
+            [ae_image.Style('big', 500)],
+            url_policy=ae_image.UrlPolicy(batch_deadline=-1))
+        ae_image.ndb_property.append_async(
+            collection, 'abc', 'image/jpeg').get_result()
+        self.assertEqual(len(collection.pending()), 1,
+            'Expect image to be pending.')
+        self.assertFalse(
+            ae_image.ndb_property.generate_urls_async(
+                collection).get_result(),
+            'Expect nothing generated once the budget has run out.')
+
+    def test_reads_db_property_segments(self):
+        album = TestDbMovedAlbum(key_name='segments')
+        album.images.append('abc', 'image/jpeg')
+        album.save()
+        album = TestDbMovedAlbum.get_by_key_name('segments')
+        album.images.append('def', 'image/jpeg')
+        album.save()
+
+        ndb.get_context().clear_cache()
+        album = ndb.Key('TestMovedAlbum', 'segments').get(use_memcache=False)
+        self.assertEqual(album.images.images.keys(), ['abc', 'def'],
+            'Expect the snapshot and delta to be read.')
+        album.put()
+        ndb.get_context().clear_cache()
+        album = ndb.Key('TestMovedAlbum', 'segments').get(use_memcache=False)
+        self.assertEqual(album.images.images.keys(), ['abc', 'def'],
+            'Expect the collection to be written back.')
+
+    def test_reads_single_pickled_collection(self):
+        collection = ae_image.Collection([ae_image.Style('thumb', size=50)])
+        collection.append('abc', 'image/jpeg')
+        TestDbMovedLegacyAlbum(key_name='legacy',
+            images=db.Blob(pickle.dumps(collection))).put()
+
+        ndb.get_context().clear_cache()
+        album = ndb.Key('TestMovedLegacyAlbum', 'legacy').get(
+            use_memcache=False)
+        self.assertEqual(album.images.images.keys(), ['abc'],
+            'Expect the pickled collection to be read.')
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Unit tests for ae_image.serving.
+
+"""
+# pylint: disable=C0111
+
+from ae_image_test import BaseTestCase
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.runtime import apiproxy_errors
+from google.appengine.ext import db
+import ae_image
+import ae_image.serving
+
+# number of images service calls that should fail, and the calls made
+_injected = {'failures': 0, 'calls': 0}
+
+
+class _BrokenRpc(object):
+    def get_result(self):
+        raise ae_image.serving.images.ObjectNotFoundError()
+
+
+def _broken_get_serving_url_async(blob_key, rpc=None):
+    # pylint: disable=W0613
+    return _BrokenRpc()
+
+
+def _failing_images_hook(service, call, request, response):
+    # pylint: disable=W0613
+    _injected['calls'] += 1
+    if _injected['failures']:
+        _injected['failures'] -= 1
+        raise apiproxy_errors.DeadlineExceededError()
+
+
+class ServingTestCase(BaseTestCase):
+    def setUp(self):
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'ae_image_failures', _failing_images_hook, 'images')
+        _injected['failures'] = 0
+        _injected['calls'] = 0
+
+    def tearDown(self):
+        _injected['failures'] = 0
+
+    def make_policy(self, **kwargs):
+        kwargs.setdefault('backoff', 0)
+        return ae_image.serving.UrlPolicy(**kwargs)
+
+    def test_breaker_opens_and_resets(self):
+        breaker = ae_image.serving.CircuitBreaker(threshold=2, reset_after=0)
+        breaker.failure()
+        self.assertTrue(breaker.allow(), 'Expect breaker to be closed.')
+        breaker.reset_after = 60
+        breaker.failure()
+        self.assertFalse(breaker.allow(), 'Expect breaker to be open.')
+        breaker.reset_after = 0
+        self.assertTrue(breaker.allow(), 'Expect breaker to allow again.')
+        breaker.success()
+        self.assertEqual(breaker.failures, 0, 'Expect failures reset.')
+
+    def test_transient_failure_is_retried(self):
+        _injected['failures'] = 1
+        image = ae_image.core.Image('abc', 'jpeg')
+        style = ae_image.Style('original')
+        modified = ae_image.serving.generate_urls(
+            [(image, style)], self.make_policy(retries=1))
+        self.assertEqual(modified, [image], 'Expect image to be modified.')
+        self.assertEqual(_injected['calls'], 2, 'Expect a retry.')
+        self.assertTrue(image.get_url(style), 'Expect URL back.')
+
+    def test_image_is_pending_when_retries_run_out(self):
+        _injected['failures'] = 10
+        collection = ae_image.Collection(
+            [ae_image.Style('big', 500)],
+            url_policy=self.make_policy(retries=2))
+        collection.append('abc', 'jpeg')
+        self.assertEqual(_injected['calls'], 3,
+            'Expect the first call and 2 retries.')
+        self.assertEqual(len(collection.pending()), 1,
+            'Expect image to be pending.')
+        self.assertRaises(ae_image.UrlNotFound, collection.get_url,
+            'big', 'abc')
+
+        _injected['failures'] = 0
+        self.assertTrue(collection.generate_urls(),
+            'Expect pending URLs to be generated.')
+        self.assertEqual(collection.pending(), [], 'Expect nothing pending.')
+
+    def test_open_breaker_skips_calls(self):
+        breaker = ae_image.serving.CircuitBreaker(threshold=1)
+        breaker.failure()
+        image = ae_image.core.Image('abc', 'jpeg')
+        modified = ae_image.serving.generate_urls(
+            [(image, ae_image.Style('original'))],
+            self.make_policy(breaker=breaker))
+        self.assertEqual(modified, [], 'Expect nothing modified.')
+        self.assertEqual(_injected['calls'], 0, 'Expect no calls.')
+
+    def test_batch_deadline_leaves_image_pending(self):
+        image = ae_image.core.Image('abc', 'jpeg')
+        modified = ae_image.serving.generate_urls(
+            [(image, ae_image.Style('original'))],
+            self.make_policy(batch_deadline=-1))
+        self.assertEqual(modified, [], 'Expect nothing modified.')
+        self.assertEqual(_injected['calls'], 0, 'Expect no calls.')
+
+    def test_properties_have_their_own_breaker(self):
+        class TestPolicyAlbum(db.Model):
+            images = ae_image.Property([ae_image.Style('thumb', size=50)])
+            covers = ae_image.Property([ae_image.Style('thumb', size=50)])
+
+        self.assertNotEqual(
+            id(TestPolicyAlbum.images.url_policy.breaker),
+            id(TestPolicyAlbum.covers.url_policy.breaker),
+            'Expect a breaker per property.')
+
+    def test_pending_image_has_no_url_in_get_urls(self):
+        collection = ae_image.Collection([ae_image.Style('big', 500)])
+        collection.add(ae_image.core.Image('abc', 'jpeg'))
+        self.assertEqual(list(collection.get_urls('big')), [('abc', None)],
+            'Expect None for the pending image.')
+
+    def test_permanent_errors_are_collected(self):
+        image = ae_image.core.Image('abc', 'jpeg')
+        style = ae_image.Style('original')
+        images = ae_image.serving.images
+        original = images.get_serving_url_async
+        images.get_serving_url_async = _broken_get_serving_url_async
+        try:
+            self.assertRaises(images.ObjectNotFoundError,
+                ae_image.serving.generate_urls, [(image, style)],
+                self.make_policy())
+            errors = []
+            modified = ae_image.serving.generate_urls(
+                [(image, style)], self.make_policy(), errors)
+        finally:
+            images.get_serving_url_async = original
+        self.assertEqual(modified, [], 'Expect nothing modified.')
+        self.assertEqual([(i, s) for i, s, _ in errors], [(image, style)],
+            'Expect the error to be collected.')
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Unit tests for ae_image.sweeper.
+
+"""
+# pylint: disable=C0111
+
+from ae_image_test import BaseTestCase
+from google.appengine.ext import blobstore, db, ndb
+import ae_image
+import ae_image.ndb_property
+import ae_image.sweeper
+import datetime
+import pickle
+
+
+class TestSweptAlbum(db.Model):
+    images = ae_image.Property([ae_image.Style('thumb', size=50)])
+
+
+class TestSweptNdbAlbum(ndb.Model):
+    images = ae_image.ndb_property.Property(
+        [ae_image.Style('thumb', size=50)])
+
+
+class TestPlainAlbum(db.Model):
+    title = db.StringProperty()
+
+
+class SweeperTestCase(BaseTestCase):
+    def make_sweeper(self, **kwargs):
+        return ae_image.sweeper.Sweeper(
+            models=[TestSweptAlbum, TestSweptNdbAlbum], batch_size=1,
+            min_age=datetime.timedelta(0), **kwargs)
+
+    def make_album(self):
+        referenced = self.make_blob('image/jpeg', 'dummy')
+        album = TestSweptAlbum()
+        album.images.append_from_blob_info(
+            blobstore.BlobInfo.get(referenced))
+        album.save()
+        return referenced
+
+    def test_models_are_required(self):
+        self.assertRaises(ValueError, ae_image.sweeper.Sweeper, [])
+        self.assertRaises(ValueError, ae_image.sweeper.Sweeper,
+            [TestPlainAlbum])
+
+    def test_image_property_names(self):
+        self.assertEqual(
+            ae_image.sweeper.image_property_names(TestSweptAlbum),
+            ['images'], 'Expect the db property.')
+        self.assertEqual(
+            ae_image.sweeper.image_property_names(TestSweptNdbAlbum),
+            ['images'], 'Expect the ndb property.')
+
+    def test_ndb_references_are_kept(self):
+        referenced = self.make_blob('image/jpeg', 'dummy')
+        album = TestSweptNdbAlbum()
+        album.images.append_from_blob_info(
+            blobstore.BlobInfo.get(referenced))
+        album.put()
+        for _ in range(2):
+            TestSweptNdbAlbum().put()
+        orphan = self.make_blob('image/jpeg', 'dummy')
+        state = self.make_sweeper().run()
+        self.assertTrue(state.done, 'Expect sweep to complete.')
+        self.assertTrue(blobstore.BlobInfo.get(referenced),
+            'Expect blob referenced by an ndb entity to be kept.')
+        self.assertFalse(blobstore.BlobInfo.get(orphan),
+            'Expect orphan to be deleted.')
+
+    def test_dry_run_keeps_orphans(self):
+        referenced = self.make_album()
+        orphan = self.make_blob('image/jpeg', 'dummy')
+        state = self.make_sweeper(dry_run=True).run()
+        self.assertTrue(state.done, 'Expect sweep to complete.')
+        self.assertEqual(state.orphaned, 1, 'Expect one orphaned blob.')
+        self.assertTrue(blobstore.BlobInfo.get(orphan),
+            'Expect orphan to be kept in a dry run.')
+        self.assertTrue(blobstore.BlobInfo.get(referenced),
+            'Expect referenced blob to be kept.')
+
+    def test_sweep_deletes_orphans(self):
+        referenced = self.make_album()
+        orphan = self.make_blob('image/jpeg', 'dummy')
+        state = self.make_sweeper().run()
+        self.assertTrue(state.done, 'Expect sweep to complete.')
+        self.assertFalse(blobstore.BlobInfo.get(orphan),
+            'Expect orphan to be deleted.')
+        self.assertTrue(blobstore.BlobInfo.get(referenced),
+            'Expect referenced blob to be kept.')
+
+    def test_sweep_resumes_from_state(self):
+        self.make_album()
+        orphan = self.make_blob('image/jpeg', 'dummy')
+        sweeper = self.make_sweeper()
+        state = sweeper.step(ae_image.sweeper.SweepState())
+        self.assertFalse(state.done, 'Expect sweep to be in progress.')
+        state = pickle.loads(pickle.dumps(state))
+        state = sweeper.run(state)
+        self.assertTrue(state.done, 'Expect sweep to complete.')
+        self.assertFalse(blobstore.BlobInfo.get(orphan),
+            'Expect orphan to be deleted.')
+
+    def test_marks_are_deleted(self):
+        self.make_album()
+        self.make_album()
+        state = self.make_sweeper().run()
+        self.assertEqual(state.marked, 2, 'Expect 2 referenced blobs.')
+        self.assertFalse(ae_image.sweeper.SweepMark.all().filter(
+            'sweep_id =', state.sweep_id).get(), 'Expect marks deleted.')
+
+    def test_young_blobs_are_kept(self):
+        orphan = self.make_blob('image/jpeg', 'dummy')
+        sweeper = ae_image.sweeper.Sweeper(models=[TestSweptAlbum])
+        state = sweeper.run()
+        self.assertEqual(state.orphaned, 0, 'Expect no orphaned blobs.')
+        self.assertTrue(blobstore.BlobInfo.get(orphan),
+            'Expect recently created blob to be kept.')
+
+    def test_non_image_blobs_are_kept(self):
+        attachment = self.make_blob('application/pdf', 'dummy')
+        state = self.make_sweeper().run()
+        self.assertEqual(state.orphaned, 0, 'Expect no orphaned blobs.')
+        self.assertTrue(blobstore.BlobInfo.get(attachment),
+            'Expect blob which is not an image to be kept.')
+
+    def test_marks_are_written_in_chunks(self):
+        album = TestSweptAlbum()
+        for _ in range(3):
+            album.images.append_from_blob_info(blobstore.BlobInfo.get(
+                self.make_blob('image/jpeg', 'dummy')))
+        album.save()
+        state = self.make_sweeper(mark_batch_size=2).run()
+        self.assertEqual(state.marked, 3, 'Expect all blobs to be marked.')
+        self.assertEqual(state.orphaned, 0, 'Expect no orphaned blobs.')
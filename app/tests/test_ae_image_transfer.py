@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Unit tests for ae_image.transfer.
+
+"""
+# pylint: disable=C0111
+
+from StringIO import StringIO
+from ae_image_test import BaseTestCase
+from google.appengine.ext import db
+import ae_image
+import ae_image.transfer
+
+
+class TestTransferAlbum(db.Model):
+    name = db.StringProperty()
+    images = ae_image.Property([
+        ae_image.Style('thumb', size=50, quality=75),
+        ae_image.Style('medium', size=300)])
+
+
+class TransferTestCase(BaseTestCase):
+    def make_albums(self, count):
+        for i in range(count):
+            album = TestTransferAlbum(key_name='album%d' % i, name='%d' % i)
+            album.images.append('abc%d' % i, 'image/jpeg')
+            album.images.append('def%d' % i, 'image/png')
+            album.save()
+
+    def export(self, **kwargs):
+        out = StringIO()
+        cursor = ae_image.transfer.export_collections(
+            TestTransferAlbum, 'images', out, **kwargs)
+        return out.getvalue().splitlines(), cursor
+
+    def test_export_writes_record_per_image(self):
+        self.make_albums(3)
+        lines, cursor = self.export()
+        self.assertEqual(len(lines), 6, 'Expect a line per image.')
+        self.assertEqual(cursor, None, 'Expect export to complete.')
+
+    def test_export_is_resumable(self):
+        self.make_albums(3)
+        lines, cursor = self.export(batch_size=2, max_batches=1)
+        self.assertEqual(len(lines), 4, 'Expect lines for a single batch.')
+        self.assertTrue(cursor, 'Expect a cursor to resume from.')
+        more, cursor = self.export(batch_size=2, cursor=cursor)
+        self.assertEqual(len(more), 2, 'Expect lines for remaining images.')
+        self.assertEqual(cursor, None, 'Expect export to complete.')
+
+    def test_import_restores_collections(self):
+        self.make_albums(3)
+        original = TestTransferAlbum.get_by_key_name('album1')
+        lines, _ = self.export()
+        db.delete(TestTransferAlbum.all(keys_only=True).fetch(10))
+
+        count = ae_image.transfer.import_collections(
+            TestTransferAlbum, 'images', lines, batch_size=2)
+        self.assertEqual(count, 3, 'Expect all entities to be imported.')
+        album = TestTransferAlbum.get_by_key_name('album1')
+        self.assertEqual(album.images.images.keys(), ['abc1', 'def1'],
+            'Expect images in order.')
+        self.assertEqual(album.images.get_url('thumb', 'def1'),
+            original.images.get_url('thumb', 'def1'),
+            'Expect the exported URL to be kept.')
+
+    def test_import_keeps_other_properties(self):
+        self.make_albums(1)
+        lines, _ = self.export()
+        ae_image.transfer.import_collections(
+            TestTransferAlbum, 'images', lines)
+        album = TestTransferAlbum.get_by_key_name('album0')
+        self.assertEqual(album.name, '0', 'Expect name to be kept.')
+
+    def test_import_generates_missing_urls(self):
+        record = {
+            'key': ['TestTransferAlbum', 'album0'],
+            'blob_key': 'abc',
+            'content_type': 'image/jpeg',
+            'urls': [[None, None, '/_ah/img/abc']],
+        }
+        line = ae_image.transfer.json.dumps(record)
+        ae_image.transfer.import_collections(
+            TestTransferAlbum, 'images', [line])
+        album = TestTransferAlbum.get_by_key_name('album0')
+        self.assertEqual(album.images.get_url('medium', 'abc'),
+            '/_ah/img/abc=s300', 'Expect the exported URL to be kept.')
+        self.assertTrue(album.images.get_url('thumb', 'abc'),
+            'Expect the missing URL to be generated.')
+
+    def test_empty_and_missing_collections_are_kept(self):
+        TestTransferAlbum(key_name='empty', name='empty').save()
+        album = TestTransferAlbum(key_name='none', name='none')
+        album.images = None
+        album.save()
+        lines, _ = self.export()
+        self.assertEqual(len(lines), 2, 'Expect a line per entity.')
+        db.delete(TestTransferAlbum.all(keys_only=True).fetch(10))
+
+        count = ae_image.transfer.import_collections(
+            TestTransferAlbum, 'images', lines)
+        self.assertEqual(count, 2, 'Expect both entities to be imported.')
+        for key_name in ('empty', 'none'):
+            album = TestTransferAlbum.get_by_key_name(key_name)
+            self.assertEqual(album.images.images.keys(), [],
+                'Expect an empty collection.')
+
+    def test_conversion_fields_are_kept(self):
+        album = TestTransferAlbum(key_name='converted')
+        image = ae_image.core.Image('abc', 'image/bmp')
+        image.blob_key = 'def'
+        image.source_blob_key = 'abc'
+        image.bytes_saved = 42
+        album.images.add(image)
+        album.save()
+        lines, _ = self.export()
+        db.delete(TestTransferAlbum.all(keys_only=True).fetch(10))
+
+        ae_image.transfer.import_collections(
+            TestTransferAlbum, 'images', lines)
+        album = TestTransferAlbum.get_by_key_name('converted')
+        image = album.images.images['abc']
+        self.assertEqual(image.blob_key, 'def', 'Expect converted blob.')
+        self.assertEqual(image.source_blob_key, 'abc', 'Expect source kept.')
+        self.assertEqual(album.images.bytes_saved, 42, 'Expect bytes saved.')